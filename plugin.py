@@ -4,10 +4,10 @@ Author: Logread,
         adapted from the Vera plugin by Antor, see:
             http://www.antor.fr/apps/smart-virtual-thermostat-eng-2/?lang=en
             https://github.com/AntorFr/SmartVT
-Version: 0.4.14 (November 13, 2023) - see history.txt for versions history
+Version: 0.5.0 (October 17, 2026) - see history.txt for versions history
 """
 """
-<plugin key="SVT" name="Smart Virtual Thermostat" author="logread" version="0.4.12" wikilink="https://www.domoticz.com/wiki/Plugins/Smart_Virtual_Thermostat.html" externallink="https://github.com/999LV/SmartVirtualThermostat.git">
+<plugin key="SVT" name="Smart Virtual Thermostat" author="logread" version="0.5.0" wikilink="https://www.domoticz.com/wiki/Plugins/Smart_Virtual_Thermostat.html" externallink="https://github.com/999LV/SmartVirtualThermostat.git">
     <description>
         <h2>Smart Virtual Thermostat</h2><br/>
         Easily implement in Domoticz an advanced virtual thermostat based on time modulation<br/>
@@ -16,15 +16,17 @@ Version: 0.4.14 (November 13, 2023) - see history.txt for versions history
         It is a port to Domoticz of the original Vera plugin from Antor.<br/>
         <h3>Set-up and Configuration</h3>
         See domoticz wiki above.<br/> 
+        Several thermostats (zones) can be run by one instance of the plugin by separating the sensors and heaters<br/>
+        of each zone by ';' (e.g. "12,13;14" for 2 zones). The outside sensors can be shared by all zones.<br/>
     </description>
     <params>
         <param field="Address" label="Domoticz IP Address" width="200px" required="true" default="localhost"/>
         <param field="Port" label="Port" width="40px" required="true" default="8080"/>
         <param field="Username" label="Username" width="200px" required="false" default=""/>
         <param field="Password" label="Password" width="200px" required="false" default=""/>
-        <param field="Mode1" label="Inside Temperature Sensors (csv list of idx)" width="100px" required="true" default="0"/>
-        <param field="Mode2" label="Outside Temperature Sensors (csv list of idx)" width="100px" required="false" default=""/>
-        <param field="Mode3" label="Heating Switches (csv list of idx)" width="100px" required="true" default="0"/>
+        <param field="Mode1" label="Inside Temperature Sensors (csv list of idx, zones separated by ';')" width="100px" required="true" default="0"/>
+        <param field="Mode2" label="Outside Temperature Sensors (csv list of idx, zones separated by ';')" width="100px" required="false" default=""/>
+        <param field="Mode3" label="Heating Switches (csv list of idx, zones separated by ';')" width="100px" required="true" default="0"/>
         <param field="Mode4" label="Apply minimum heating per cycle" width="200px">
             <options>
 		<option label="only when heating required" value="Normal"  default="true" />
@@ -49,11 +51,76 @@ Version: 0.4.14 (November 13, 2023) - see history.txt for versions history
 """
 import Domoticz
 import json
-from urllib import parse, request
-from datetime import datetime, timedelta
+from urllib import parse
+from datetime import datetime, timedelta, timezone
 import time
 import base64
 import itertools
+import http.client
+import socket
+import threading
+import queue
+import os
+import collections
+import ast
+import concurrent.futures
+import heapq
+import math
+import functools
+import contextlib
+import cProfile
+import pstats
+import sys
+import codecs
+import re
+import struct
+import mmap
+numpy = None  # only imported when the batch calibration is configured, see loadNumpy()
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # the history file is then written without a lock (Windows)
+
+
+def loadNumpy():
+    """imports numpy for the batch calibration, returns False if it cannot be imported"""
+
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except Exception as error:  # e.g. numpy refuses to load in a second sub-interpreter of Domoticz
+            _log.Error("Batch calibration requires the numpy python module, which cannot be imported ({}): "
+                       "using incremental calibration", error)
+            return False
+    return True
+
+
+# time source of the thermostats, replaced by a simulated clock when the plugin is run by tools/svt_simulator.py
+clock = datetime.now
+
+
+def timed(name):
+    """decorator adding the execution time of the decorated method to the plugin metrics"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _metrics.timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profiled(function):
+    """decorator running the decorated method of the plugin under its profiler, when profiling is on"""
+
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        if self.profiler is None or not self.profiler.active:
+            return function(self, *args, **kwargs)
+        return self.profiler.run(function, self, *args, **kwargs)
+    return wrapper
 
 
 class deviceparam:
@@ -75,40 +142,24 @@ class BasePlugin:
         self.pauseondelay = 2  # time between pause sensor actuation and actual pause
         self.pauseoffdelay = 1  # time between end of pause sensor actuation and end of actual pause
         self.forcedduration = 60  # time in minutes for the forced mode
-        self.ActiveSensors = {}
-        self.InTempSensors = []
-        self.OutTempSensors = []
-        self.Heaters = []
-        self.InternalsDefaults = {
-            'ConstC': float(60),  # inside heating coeff, depends on room size & power of your heater (60 by default)
-            'ConstT': float(1),  # external heating coeff,depends on the insulation relative to the outside (1 by default)
-            'nbCC': 0,  # number of learnings for ConstC
-            'nbCT': 0,  # number of learnings for ConstT
-            'LastPwr': 0,  # % power from last calculation
-            'LastInT': float(0),  # inside temperature at last calculation
-            'LastOutT': float(0),  # outside temprature at last calculation
-            'LastSetPoint': float(20),  # setpoint at time of last calculation
-            'ALStatus': 0}  # AutoLearning status (0 = uninitialized, 1 = initialized, 2 = disabled)
-        self.Internals = self.InternalsDefaults.copy()
-        self.heat = False
-        self.pause = False
-        self.pauserequested = False
-        self.pauserequestchangedtime = datetime.now()
-        self.forced = False
-        self.boost = True  # boost heating when boostgap is reached
-        self.boostgap = 0.5  # gap in °C between inside temp and setpoint above which turbo mode is active
-        self.intemp = 20.0
-        self.outtemp = 20.0
-        self.setpoint = 20.0
-        self.endheat = datetime.now()
-        self.nextcalc = self.endheat
-        self.lastcalc = self.endheat
-        self.nextupdate = self.endheat
-        self.nexttemps = self.endheat
-        self.learn = True
+        self.zones = []  # the thermostats managed by this plugin instance
+        self.pendingheaters = {}  # heater switch states requested by the zones since the last actuation pass
+        self.nexttemps = clock()
         self.loglevel = None
-        self.intemperror = False
         self.versionsupported = False
+        self.worker = None
+        self.actuator = None
+        self.store = None
+        self.transitions = None  # heat, forced and pause states of the zones in the last runtime state written
+        self.history = None
+        self.archive = None
+        self.subscriber = None
+        self.health = None
+        self.scheduler = None
+        self.heartbeat = 10  # current heartbeat interval in seconds (default of Domoticz)
+        self.nextmetrics = None
+        self.profiler = None
+        self.config = {}
         return
 
 
@@ -135,104 +186,599 @@ class BasePlugin:
         if version >= 2023.2:
             self.versionsupported = True
         else:
-            Domoticz.Error("Minimum domoticz version is 2023.2")
+            _log.Error("Minimum domoticz version is 2023.2")
             return
 
-        # create the child devices if these do not exist yet
-        devicecreated = []
-        if 1 not in Devices:
-            Options = {"LevelActions": "||",
-                       "LevelNames": "Off|Auto|Forced",
-                       "LevelOffHidden": "false",
-                       "SelectorStyle": "0"}
-            Domoticz.Device(Name="Thermostat Control", Unit=1, TypeName="Selector Switch", Switchtype=18, Image=15,
-                            Options=Options, Used=1).Create()
-            devicecreated.append(deviceparam(1, 0, "0"))  # default is Off state
-        if 2 not in Devices:
-            Options = {"LevelActions": "||",
-                       "LevelNames": "Off|Normal|Economy",
-                       "LevelOffHidden": "true",
-                       "SelectorStyle": "0"}
-            Domoticz.Device(Name="Thermostat Mode", Unit=2, TypeName="Selector Switch", Switchtype=18, Image=15,
-                            Options=Options, Used=1).Create()
-            devicecreated.append(deviceparam(2, 0, "10"))  # default is normal mode
-        if 3 not in Devices:
-            Domoticz.Device(Name="Thermostat Pause", Unit=3, TypeName="Switch", Image=9, Used=1).Create()
-            devicecreated.append(deviceparam(3, 0, ""))  # default is Off
-        if 4 not in Devices:
-            Domoticz.Device(Name="Setpoint Normal", Unit=4, Type=242, Subtype=1, Used=1).Create()
-            devicecreated.append(deviceparam(4, 0, "20"))  # default is 20 degrees
-        if 5 not in Devices:
-            Domoticz.Device(Name="Setpoint Economy", Unit=5, Type=242, Subtype=1, Used=1).Create()
-            devicecreated.append(deviceparam(5 ,0, "20"))  # default is 20 degrees
-        if 6 not in Devices:
-            Domoticz.Device(Name="Thermostat temp", Unit=6, TypeName="Temperature").Create()
-            devicecreated.append(deviceparam(6, 0, "20"))  # default is 20 degrees
-
-        # if any device has been created in onStart(), now is time to update its defaults
-        for device in devicecreated:
-            Devices[device.unit].Update(nValue=device.nvalue, sValue=device.svalue)
-
-        # build lists of sensors and switches
-        self.InTempSensors = parseCSV(Parameters["Mode1"])
-        self.WriteLog("Inside Temperature sensors = {}".format(self.InTempSensors), "Verbose")
-        self.OutTempSensors = parseCSV(Parameters["Mode2"])
-        self.WriteLog("Outside Temperature sensors = {}".format(self.OutTempSensors), "Verbose")
-        self.Heaters = parseCSV(Parameters["Mode3"])
-        self.WriteLog("Heaters = {}".format(self.Heaters), "Verbose")
-        
-        # build dict of status of all temp sensors to be used when handling timeouts
-        for sensor in itertools.chain(self.InTempSensors, self.OutTempSensors):
-            self.ActiveSensors[sensor] = True
+        # read the optional advanced settings
+        self.config = loadConfig()
+        self.config["HeartbeatIdle"] = min(30, self.config["HeartbeatIdle"])
+        self.config["HeartbeatFine"] = max(1, min(self.config["HeartbeatIdle"], self.config["HeartbeatFine"]))
+        _log.setup(debuglevel & 2 != 0, self.loglevel == "Verbose", self.config["LogBufferSize"])
+        if self.config["Calibration"] == "batch" and not loadNumpy():
+            self.config["Calibration"] = "incremental"
+        if self.config["AdaptivePeriod"]:
+            self.config["PeriodMin"] = max(self.config["PeriodMin"], 5)
+            self.config["PeriodMax"] = max(self.config["PeriodMax"], self.config["PeriodMin"])
+        self.scheduler = Scheduler()
+        self.health = SensorHealth(int(Settings["SensorTimeout"]),
+                                   self.config["TempAggregation"], self.config["SpikeThreshold"])
 
         # splits additional parameters
         params = parseCSV(Parameters["Mode5"])
         if len(params) == 5 or len(params) == 6:
             self.calculate_period = CheckParam("Calculation Period", params[0], 30)
             if self.calculate_period < 5:
-                Domoticz.Error("Invalid calculation period parameter. Using minimum of 5 minutes !")
+                _log.Error("Invalid calculation period parameter. Using minimum of 5 minutes !")
                 self.calculate_period = 5
             self.minheatpower = CheckParam("Minimum Heating (%)", params[1], 0)
             if self.minheatpower > 100:
-                Domoticz.Error("Invalid minimum heating parameter. Using maximum of 100% !")
+                _log.Error("Invalid minimum heating parameter. Using maximum of 100% !")
                 self.minheatpower = 100
             self.pauseondelay = CheckParam("Pause On Delay", params[2], 2)
             self.pauseoffdelay = CheckParam("Pause Off Delay", params[3], 0)
             self.forcedduration = CheckParam("Forced Mode Duration", params[4], 60)
             if self.forcedduration < 15:
-                Domoticz.Error("Invalid forced mode duration parameter. Using minimum of 15 minutes !")
+                _log.Error("Invalid forced mode duration parameter. Using minimum of 15 minutes !")
                 self.forcedduration = 15
             if len(params) > 5:
                 self.deltamax = CheckParam("Delta max", params[5], 0.2)
             else:
-                Domoticz.Error("Delta max missing in parameters. Add the field in the plugin configuration (default value=0.2)")
+                _log.Error("Delta max missing in parameters. Add the field in the plugin configuration (default value=0.2)")
         else:
-            Domoticz.Error("Error reading Mode5 parameters")
+            _log.Error("Error reading Mode5 parameters")
+
+        # build lists of sensors and switches, one list per zone (zones are separated by ';')
+        InTempSensors = parseZones(Parameters["Mode1"])
+        OutTempSensors = parseZones(Parameters["Mode2"])
+        Heaters = parseZones(Parameters["Mode3"])
+        if len(InTempSensors) != len(Heaters):
+            _log.Error("The inside temperature sensors and heaters parameters do not list the same number of zones !")
+        if len(OutTempSensors) == 1:
+            # the outside temperature sensors are shared by all the zones
+            OutTempSensors = OutTempSensors * len(InTempSensors)
+        elif len(OutTempSensors) != len(InTempSensors):
+            _log.Error("The outside temperature sensors parameter does not list the same number of zones !")
+        self.zones = [Zone(self, number, intemps, outtemps, heaters) for number, (intemps, outtemps, heaters) in
+                      enumerate(zip(InTempSensors, OutTempSensors, Heaters), start=1)]
 
-        # loads persistent variables from dedicated user variable
-        # note: to reset the thermostat to default values (i.e. ignore all past learning),
-        # just delete the relevant "<plugin name>-InternalVariables" user variable Domoticz GUI and restart plugin
-        self.getUserVar()
+        # create the child devices if these do not exist yet
+        devicecreated = []
+        for zone in self.zones:
+            zone.createDevices(devicecreated)
 
-        # if mode = off then make sure actual heating is off just in case if was manually set to on
-        if Devices[1].sValue == "0":
-            self.switchHeat(False)
+        # if any device has been created in onStart(), now is time to update its defaults
+        for device in devicecreated:
+            Devices[device.unit].Update(nValue=device.nvalue, sValue=device.svalue)
+        for zone in self.zones:
+            zone.checkDevices()
+        if self.config["MetricsDevice"] and 9 not in Devices:
+            Domoticz.Device(Name="Thermostat Metrics", Unit=9, Type=243, Subtype=19, Used=0).Create()
+        if self.config["MetricsFormat"] != "" or self.config["MetricsDevice"]:
+            self.nextmetrics = clock() + timedelta(minutes=self.config["MetricsInterval"])
+        self.profiler = Profiler(
+            os.path.join(Parameters["HomeFolder"], "svt_profile_{}".format(Parameters["HardwareID"])),
+            self.config["ProfileHeartbeats"], self.onProfiled)
+        if self.config["ProfilingDevice"] and 8 not in Devices:
+            Domoticz.Device(Name="Thermostat Profiling", Unit=8, TypeName="Switch", Image=9, Used=0).Create()
+        if self.config["ProfileAtStart"]:
+            self.profiler.start()
+
+        # setup the pool of connections to the Domoticz json API (credentials are only encoded once)
+        # and the worker thread that makes all the API calls on behalf of the plugin thread
+        _api.setup(Parameters["Address"], Parameters["Port"], Parameters["Username"], Parameters["Password"])
+        _api.configure(self.config["APITimeout"], self.config["BreakerThreshold"], self.config["BreakerBackoff"],
+                       self.config["BreakerMaxBackoff"], self.config["APICacheTTL"] * 60)
+        _api.targetedshare = self.config["TargetedShare"]
+        if self.config["SharedSnapshot"]:
+            if fcntl is not None:
+                _api.snapshot = DeviceSnapshot(os.path.join(Parameters["HomeFolder"], "svt_devices"),
+                                               self.config["SharedSnapshotTTL"])
+            else:
+                _log.Error("The shared device snapshot requires file locks, not available on this system")
+        self.worker = APIWorker()
+        self.worker.profiler = self.profiler
+        self.worker.start()
+        groups = {}
+        for zone, group in self.config["HeaterGroups"].items():
+            if zone.isdigit() and 0 < int(zone) <= len(self.zones) and type(group) is int:
+                groups[group] = self.zones[int(zone) - 1].Heaters
+            else:
+                _log.Error("Invalid heater group {}: {} in advanced settings", zone, group)
+        self.actuator = HeaterActuator(self.config["HeaterStateTTL"], groups, self.config["SwitchThreads"],
+                                       self.config["SwitchRetries"], self.config["SwitchRetryDelay"])
+
+        # loads persistent variables from the local file of the plugin instance
+        # note: to reset the thermostats to default values (i.e. ignore all past learning), just delete the
+        # "svt_internals_<hardware id>.json" file in the plugin folder (and the "<plugin name>-InternalVariables"
+        # user variable(s) in Domoticz GUI if used) and restart plugin
+        self.store = PersistentStore(
+            os.path.join(Parameters["HomeFolder"], "svt_internals_{}.json".format(Parameters["HardwareID"])),
+            self.config["InternalsFlushInterval"])
+        self.loadInternals()
+
+        # archive of the calculation cycles
+        if self.config["CycleArchive"]:
+            self.archive = CycleArchive(
+                os.path.join(Parameters["HomeFolder"], "svt_cycles_{}.bin".format(Parameters["HardwareID"])),
+                self.config["CycleBuffer"], self.config["CycleArchiveDays"], self.config["InternalsFlushInterval"])
+
+        # downsampled history of the zones, published in the www/templates folder of Domoticz for the SVT viewer
+        if self.config["History"]:
+            folder = os.path.join(Parameters["StartupFolder"], "www", "templates")
+            if os.path.isdir(folder):
+                self.history = History(os.path.join(folder, "svt_history.json"),
+                                       str(Parameters["HardwareID"]), self.config["HistoryStep"],
+                                       self.config["HistoryDays"], self.config["HistoryInterval"])
+                self.history.load({zone.number: zone.name() for zone in self.zones})
+            else:
+                Domoticz.Status("Folder {} not found: the history of the thermostats is not published".format(folder))
+
+        # resume the cycles in progress when the plugin was stopped, if it was not stopped for too long
+        resumed = self.resume(self.store.runtime)
+
+        for zone in self.zones:
+            # if mode = off then make sure actual heating is off just in case if was manually set to on
+            if Devices[zone.unit(1)].sValue == "0" and zone not in resumed:
+                zone.switchHeat(False)
+        self.actuate()
+
+        # subscribe to the temperatures pushed by Domoticz on its MQTT output, if configured
+        if self.config["MQTTAddress"] != "":
+            sensors = set()
+            for zone in self.zones:
+                sensors.update(zone.InTempSensors, zone.OutTempSensors)
+            self.subscriber = TempSubscriber(self.config["MQTTAddress"], self.config["MQTTPort"],
+                                             self.config["MQTTTopic"], sensors, self.config["PushTimeout"])
+            self.subscriber.connect()
+
+        # the first heartbeat runs all the zones
+        now = clock()
+        for zone in self.zones:
+            self.scheduler.schedule(zone.number, now)
+        self.reschedule(now)
 
 
     def onStop(self):
 
+        if self.subscriber is not None:
+            self.subscriber.disconnect()
+        if self.store is not None:
+            self.store.updateRuntime(self.runtime())
+            self.store.flush(force=True)
+        if self.history is not None:
+            self.history.write(force=True)
+        if self.archive is not None:
+            self.archive.spill(force=True)
+        if self.profiler is not None:
+            self.profiler.stop()
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
+        if self.actuator is not None:
+            self.actuator.shutdown()
+        _api.close()
         Domoticz.Debugging(0)
 
 
+    @profiled
     def onCommand(self, Unit, Command, Level, Color):
 
-        Domoticz.Debug("onCommand called for Unit {}: Command '{}', Level: {}".format(Unit, Command, Level))
+        _log.Debug("onCommand called for Unit {}: Command '{}', Level: {}", Unit, Command, Level)
+        # if host domoticz version is not OK than do nothing
+        if not self.versionsupported:
+            return
+
+        if Unit == 8:  # profiling switch
+            if str(Command) == "On":
+                Devices[8].Update(nValue=1, sValue="On")
+                self.profiler.start()
+            else:
+                self.profiler.stop()
+                Devices[8].Update(nValue=0, sValue="Off")
+            return
+
+        number = (Unit - 1) // 10 + 1
+        if number > len(self.zones):
+            _log.Error("Unit {} does not belong to any zone", Unit)
+            return
+        zone = self.zones[number - 1]
+        self.scheduler.schedule(zone.number, clock())  # the zone has to check its new state
+        if zone.onCommand(Unit - zone.base, Command, Level):
+            self.onHeartbeat()
+
+
+    def onDeviceRemoved(self, Unit):
+
+        number = (Unit - 1) // 10 + 1
+        if number <= len(self.zones):
+            self.zones[number - 1].onDeviceRemoved(Unit - self.zones[number - 1].base)
+
+
+    def onConnect(self, Connection, Status, Description):
+
+        if self.subscriber is not None:
+            self.subscriber.onConnect(Connection, Status, Description)
+
+
+    def onMessage(self, Connection, Data):
+
+        if self.subscriber is not None:
+            self.subscriber.onMessage(Connection, Data)
+
+
+    def onDisconnect(self, Connection):
+
+        if self.subscriber is not None:
+            self.subscriber.onDisconnect(Connection)
+
+
+    @timed("onHeartbeat")
+    @profiled
+    def onHeartbeat(self):
+
         # if host domoticz version is not OK than do nothing
         if not self.versionsupported:
             return
 
+        now = clock()
+
+        # run the completion callbacks of the API calls made by the worker thread since last heartbeat
+        busy = self.worker.processResults() > 0
+
+        # handle the temperatures pushed since last heartbeat
+        if self.subscriber is not None and self.subscriber.updated and self.subscriber.active(now):
+            self.onPushedTemps(now)
+            busy = True
+
+        # nothing else to do until the next timer is due
+        due = self.scheduler.due(now, timedelta(seconds=self.heartbeat + 1))
+        if not busy and not due:
+            self.adaptHeartbeat(now)
+            return
+
+        if "ping" in due:
+            self.subscriber.onHeartbeat(now)
+
+        # run each thermostat that is due, and collect the ones that need new temperatures to start a new calculation
+        calczones = [zone for zone in self.zones if zone.number in due and zone.onHeartbeat(now)]
+
+        if calczones or "temps" in due:
+            # call the Domoticz json API for a temperature devices update, to get the lastest temps (and avoid the
+            # connection time out time after 10mins that floods domoticz logs in versions of domoticz since spring 2018)
+            self.readTemps(calczones)
+
+        # switch in one pass all the heaters that the zones requested
+        self.actuate()
+
+        # log the sensors that timed out since the last heartbeat
+        if "health" in due:
+            self.health.expire(now)
+
+        # write the learned internals and the runtime state to disk if they changed and the flush interval is over,
+        # or at once if a zone switched its heaters, forced mode or pause: resuming from an older state after a
+        # crash could switch the heaters back on
+        transitions = [zone.transition() for zone in self.zones]
+        self.store.updateRuntime(self.runtime())
+        self.store.flush(force=transitions != self.transitions)
+        self.transitions = transitions
+        if self.history is not None:
+            self.history.write()
+        if self.archive is not None:
+            self.archive.spill()
+
+        if "metrics" in due:
+            self.exportMetrics(now)
+
+        self.reschedule(now)
+        self.adaptHeartbeat(now)
+
+
+    def reschedule(self, now):
+
+        # the timers of the zones and of the plugin may have been changed by the heartbeat or the callbacks
+        for zone in self.zones:
+            self.scheduler.schedule(zone.number, zone.nextEvent(now))
+        self.scheduler.schedule("temps", self.nexttemps)
+        if self.subscriber is not None:
+            self.scheduler.schedule("ping", self.subscriber.nextping)
+        self.scheduler.schedule("health", self.health.next())
+        self.scheduler.schedule("flush", self.store.nextflush if self.store.dirty else None)
+        self.scheduler.schedule("metrics", self.nextmetrics)
+        if self.history is not None:
+            self.scheduler.schedule("history", self.history.nextwrite if self.history.dirty else None)
+
+
+    def onProfiled(self):
+
+        if 8 in Devices and Devices[8].nValue != 0:
+            Devices[8].Update(nValue=0, sValue="Off")
+
+
+    def exportMetrics(self, now):
+
+        self.nextmetrics = now + timedelta(minutes=self.config["MetricsInterval"])
+        gauges = {"heartbeat_interval_seconds": self.heartbeat,
+                  "timer_max_slippage_seconds": timedelta.total_seconds(self.scheduler.maxslippage)}
+        if self.config["MetricsFormat"] != "":
+            filename = os.path.join(Parameters["HomeFolder"], "svt_metrics_{}.{}".format(
+                Parameters["HardwareID"], "prom" if self.config["MetricsFormat"] == "prometheus" else "json"))
+            _metrics.export(filename, self.config["MetricsFormat"], gauges)
+        if self.config["MetricsDevice"] and 9 in Devices:
+            Devices[9].Update(nValue=0, sValue=_metrics.summary())
+
+
+    def adaptHeartbeat(self, now):
+
+        # beat often while API calls are pending or a timer is close, rarely when idle
+        nextdue = self.scheduler.next()
+        if nextdue is None:
+            interval = self.config["HeartbeatIdle"]
+        else:
+            interval = math.ceil(timedelta.total_seconds(nextdue - now))
+            # the end of a heat cycle is met within a second, by a burst of short heartbeats if needed
+            shortest = 1 if any(zone.heat and zone.endheat <= nextdue for zone in self.zones) \
+                else self.config["HeartbeatFine"]
+            interval = max(shortest, min(self.config["HeartbeatIdle"], interval))
+        if self.worker.pending():
+            interval = min(interval, self.config["HeartbeatFine"])
+        if interval != self.heartbeat:
+            self.heartbeat = interval
+            Domoticz.Heartbeat(interval)
+
+
+    def readTemps(self, calczones):
+
+        # set update flag for next temp update
+        self.nexttemps = clock() + timedelta(minutes=5)
+
+        # if the temperatures are pushed by Domoticz, there is no need to call the API
+        if self.subscriber is not None and self.subscriber.active(clock()):
+            self.onTemps(self.subscriber.temps, calczones)
+            return
+
+        # fetch the sensors of all the zones at once from the API in the worker thread...
+        # the thermostat work of the zones in calczones is then done once the temperatures are received
+        sensors = set()
+        for zone in self.zones:
+            sensors.update(zone.InTempSensors, zone.OutTempSensors)
+        self.worker.submit(lambda: self.fetchTemps(sensors), lambda devices: self.onTemps(devices, calczones))
+
+
+    @timed("readTemps")
+    def fetchTemps(self, sensors):
+        """job of the worker thread: reads the temperature sensors from the API, timed with their parsing"""
+
+        return DomoticzDevices(sensors, "temp")
+
+
+    def onTemps(self, devices, calczones):
+
+        devices = devices or {}  # None if the read failed with an exception in the worker thread
+        if self.subscriber is not None:
+            self.subscriber.baseline(devices)
+        self.health.update(devices, clock())
+        for zone in self.zones:
+            zone.onTemps(devices, zone in calczones)
+
+
+    def onPushedTemps(self, now):
+
+        updated, self.subscriber.updated = self.subscriber.updated, set()
+        self.health.update({idx: self.subscriber.temps[idx] for idx in updated}, now)
+        for zone in self.zones:
+            if not updated.isdisjoint(zone.InTempSensors) or not updated.isdisjoint(zone.OutTempSensors):
+                zone.onTemps(self.subscriber.temps, False)
+                zone.checkThreshold(now, self.config["PushThreshold"])
+
+
+    def requestHeaters(self, heaters, switch):
+
+        for idx in heaters:
+            self.pendingheaters[idx] = switch
+
+
+    def actuate(self):
+
+        if self.pendingheaters:
+            desired, self.pendingheaters = self.pendingheaters, {}
+            self.worker.submit(lambda: self.actuator.switch(desired), self.onActuated)
+
+
+    def onActuated(self, result):
+
+        changed, failed = result or ({}, [])
+        _metrics.switched(changed)
+        if changed:
+            _log.Debug("Heaters switched: {}", changed)
+        if failed:
+            _log.Error("Failed to switch heater(s) {}", ", ".join(str(idx) for idx in failed))
+
+
+    def runtime(self):
+        """returns the state of the thermostats, to resume their cycles after a restart"""
+
+        return {"nexttemps": timeToStr(self.nexttemps),
+                "zones": {str(zone.number): zone.runtime() for zone in self.zones},
+                "heaters": self.actuator.snapshot(),
+                "sensors": self.health.snapshot()}
+
+
+    def resume(self, runtime):
+        """restores the state saved by runtime(), returns the list of the zones resumed"""
+
+        now = clock()
+        try:
+            saved = strToTime(runtime["saved"])
+        except (KeyError, ValueError, TypeError):
+            return []
+        longest = max(self.calculate_period, self.config["PeriodMax"] if self.config["AdaptivePeriod"] else 0)
+        if saved > now or now - saved > timedelta(minutes=longest):
+            Domoticz.Status("Saved state is too old to resume the thermostats: starting afresh")
+            return []
+        resumed = [zone for zone in self.zones if zone.resume(runtime.get("zones", {}).get(str(zone.number)))]
+        if resumed:
+            self.health.restore(runtime.get("sensors", {}), now)
+            self.actuator.restore(runtime.get("heaters", {}))
+            try:
+                self.nexttemps = min(strToTime(runtime["nexttemps"]), now + timedelta(minutes=5))
+            except (KeyError, ValueError, TypeError):
+                self.nexttemps = now
+            Domoticz.Status("Resumed the cycle in progress of {} zone(s) from the state saved on {}".format(
+                len(resumed), saved))
+        return resumed
+
+
+    def loadInternals(self):
+
+        data = self.store.load()
+        missing = [zone for zone in self.zones if not zone.restore(data.get(str(zone.number)))]
+        if missing or self.config["MirrorUserVariable"]:
+            # the learning of zones not yet in the local file is recovered from the user variables
+            # used by previous versions of the plugin
+            self.getUserVars(missing)
+
+
+    def getUserVars(self, missing):
+
+        self.worker.submit(lambda: DomoticzAPI("type=command&param=getuservariables"),
+                           lambda variables: self.onUserVars(variables, missing))
+
+
+    def onUserVars(self, variables, missing):
+
+        for zone in self.zones:
+            zone.onUserVar(variables, zone in missing)
+
+
+class Zone:
+    """One thermostat of the plugin: its devices (Units 1 to 6 for the first zone, then 11 to 16, etc...),
+    sensors, heaters, learning and schedule"""
+
+    def __init__(self, plugin, number, InTempSensors, OutTempSensors, Heaters):
+
+        self.plugin = plugin
+        self.number = number
+        self.base = 10 * (number - 1)  # offset of the Units of the zone's devices
+        self.prefix = "" if number == 1 else "Zone {} ".format(number)
+        self.calculate_period = plugin.calculate_period  # base period, for which the learned constants are valid
+        self.period = self.calculate_period  # period of the current cycle, adapted if AdaptivePeriod is set
+        self.minheatpower = plugin.minheatpower
+        self.deltamax = plugin.deltamax
+        self.pauseondelay = plugin.pauseondelay
+        self.pauseoffdelay = plugin.pauseoffdelay
+        self.forcedduration = plugin.forcedduration
+        self.InTempSensors = InTempSensors
+        self.OutTempSensors = OutTempSensors
+        self.Heaters = Heaters
+        self.InternalsDefaults = {
+            'ConstC': float(60),  # inside heating coeff, depends on room size & power of your heater (60 by default)
+            'ConstT': float(1),  # external heating coeff,depends on the insulation relative to the outside (1 by default)
+            'nbCC': 0,  # number of learnings for ConstC
+            'nbCT': 0,  # number of learnings for ConstT
+            'LastPwr': 0,  # % power from last calculation
+            'LastInT': float(0),  # inside temperature at last calculation
+            'LastOutT': float(0),  # outside temprature at last calculation
+            'LastSetPoint': float(20),  # setpoint at time of last calculation
+            'ALStatus': 0}  # AutoLearning status (0 = uninitialized, 1 = initialized, 2 = disabled)
+        self.Internals = self.InternalsDefaults.copy()
+        self.heat = False
+        self.pause = False
+        self.pauserequested = False
+        self.pauserequestchangedtime = clock()
+        self.forced = False
+        self.boost = plugin.config["Boost"]  # boost heating when boostgap is reached
+        self.boostgap = plugin.config["BoostGap"]  # gap in °C between inside temp and setpoint above which boost is active
+        self.intemp = 20.0
+        self.outtemp = 20.0
+        self.setpoint = 20.0
+        self.endheat = clock()
+        self.nextcalc = self.endheat
+        self.lastcalc = self.endheat
+        self.nextupdate = self.endheat
+        self.learn = True
+        self.intemperror = False
+        self.lastcycle = None  # (power, inside temp, outside temp) at the start of the current cycle
+        self.devicesok = False
+        self.heaterstart = None  # time at which the heaters were last switched on, None if off
+        self.heatseconds = 0  # seconds of heating in the current cycle, until heaterstart
+        self.switches = 0  # heater switches since the last adaptive period summary
+        self.calculations = 0  # calculations since the last adaptive period summary
+        self.calcminutes = 0.  # minutes covered by these calculations
+        self.nextsummary = clock() + timedelta(days=1)
+        self.cycles = collections.deque(maxlen=plugin.config["CalibrationWindow"])  # history for batch calibration
+
+        self.WriteLog("Inside Temperature sensors = {}", "Verbose", self.InTempSensors)
+        self.WriteLog("Outside Temperature sensors = {}", "Verbose", self.OutTempSensors)
+        self.WriteLog("Heaters = {}", "Verbose", self.Heaters)
+
+
+    def unit(self, unit):
+
+        return self.base + unit
+
+
+    def checkDevices(self):
+
+        # fool proof checking.... based on users feedback
+        self.devicesok = all(self.unit(device) in Devices for device in (1,2,3,4,5,6))
+        if not self.devicesok:
+            _log.Error("one or more devices required by the plugin is/are missing, please check domoticz device creation settings and restart !")
+
+
+    def onDeviceRemoved(self, Unit):
+
+        if Unit in (1, 2, 3, 4, 5, 6):
+            self.devicesok = False
+            _log.Error("a device required by the plugin was removed, please restart the plugin to recreate it !")
+
+
+    def createDevices(self, devicecreated):
+
+        if self.unit(1) not in Devices:
+            Options = {"LevelActions": "||",
+                       "LevelNames": "Off|Auto|Forced",
+                       "LevelOffHidden": "false",
+                       "SelectorStyle": "0"}
+            Domoticz.Device(Name=self.prefix + "Thermostat Control", Unit=self.unit(1), TypeName="Selector Switch",
+                            Switchtype=18, Image=15, Options=Options, Used=1).Create()
+            devicecreated.append(deviceparam(self.unit(1), 0, "0"))  # default is Off state
+        if self.unit(2) not in Devices:
+            Options = {"LevelActions": "||",
+                       "LevelNames": "Off|Normal|Economy",
+                       "LevelOffHidden": "true",
+                       "SelectorStyle": "0"}
+            Domoticz.Device(Name=self.prefix + "Thermostat Mode", Unit=self.unit(2), TypeName="Selector Switch",
+                            Switchtype=18, Image=15, Options=Options, Used=1).Create()
+            devicecreated.append(deviceparam(self.unit(2), 0, "10"))  # default is normal mode
+        if self.unit(3) not in Devices:
+            Domoticz.Device(Name=self.prefix + "Thermostat Pause", Unit=self.unit(3), TypeName="Switch", Image=9,
+                            Used=1).Create()
+            devicecreated.append(deviceparam(self.unit(3), 0, ""))  # default is Off
+        if self.unit(4) not in Devices:
+            Domoticz.Device(Name=self.prefix + "Setpoint Normal", Unit=self.unit(4), Type=242, Subtype=1,
+                            Used=1).Create()
+            devicecreated.append(deviceparam(self.unit(4), 0, "20"))  # default is 20 degrees
+        if self.unit(5) not in Devices:
+            Domoticz.Device(Name=self.prefix + "Setpoint Economy", Unit=self.unit(5), Type=242, Subtype=1,
+                            Used=1).Create()
+            devicecreated.append(deviceparam(self.unit(5), 0, "20"))  # default is 20 degrees
+        if self.unit(6) not in Devices:
+            Domoticz.Device(Name=self.prefix + "Thermostat temp", Unit=self.unit(6), TypeName="Temperature").Create()
+            devicecreated.append(deviceparam(self.unit(6), 0, "20"))  # default is 20 degrees
+        if self.plugin.config["Calibration"] == "batch" and self.unit(7) not in Devices:
+            Domoticz.Device(Name=self.prefix + "Thermostat Calibration", Unit=self.unit(7), TypeName="Switch",
+                            Switchtype=9, Image=9, Used=1).Create()
+
+
+    def onCommand(self, Unit, Command, Level):
+
+        if Unit == 7:  # push button requesting a batch calibration now
+            if self.BatchCallib():
+                self.saveInternals()
+            return False
+
         if Unit == 3:  # pause switch
-            self.pauserequestchangedtime = datetime.now()
+            self.pauserequestchangedtime = clock()
             svalue = ""
             if str(Command) == "On":
                 nvalue = 1
@@ -244,46 +790,41 @@ class BasePlugin:
             nvalue = 1 if Level > 0 else 0
             svalue = str(Level)
 
-        Devices[Unit].Update(nValue=nvalue, sValue=svalue)
+        Devices[self.unit(Unit)].Update(nValue=nvalue, sValue=svalue)
 
         if Unit in (1, 2, 4, 5): # force recalculation if control or mode or a setpoint changed
-            self.nextcalc = datetime.now()
+            self.nextcalc = clock()
             self.learn = False
-            self.onHeartbeat()
-
+            return True
+        return False
 
-    def onHeartbeat(self):
-
-        # if host domoticz version is not OK than do nothing
-        if not self.versionsupported:
-            return
 
-        now = datetime.now()
+    def onHeartbeat(self, now):
+        """returns True if a new calculation is to be made once the temperatures are read"""
 
-        # fool proof checking.... based on users feedback
-        if not all(device in Devices for device in (1,2,3,4,5,6)):
-            Domoticz.Error("one or more devices required by the plugin is/are missing, please check domoticz device creation settings and restart !")
-            return
+        calculate = False
+        if not self.devicesok:
+            return calculate
 
-        if Devices[1].sValue == "0":  # Thermostat is off
+        if Devices[self.unit(1)].sValue == "0":  # Thermostat is off
             if self.forced or self.heat:  # thermostat setting was just changed so we kill the heating
                 self.forced = False
                 self.endheat = now
-                Domoticz.Debug("Switching heat Off !")
+                _log.Debug("Switching heat Off !")
                 self.switchHeat(False)
 
-        elif Devices[1].sValue == "20":  # Thermostat is in forced mode
+        elif Devices[self.unit(1)].sValue == "20":  # Thermostat is in forced mode
             if self.forced:
                 if self.endheat <= now:
                     self.forced = False
                     self.endheat = now
-                    Domoticz.Debug("Forced mode Off !")
-                    Devices[1].Update(nValue=1, sValue="10")  # set thermostat to normal mode
+                    _log.Debug("Forced mode Off !")
+                    Devices[self.unit(1)].Update(nValue=1, sValue="10")  # set thermostat to normal mode
                     self.switchHeat(False)
             else:
                 self.forced = True
                 self.endheat = now + timedelta(minutes=self.forcedduration)
-                Domoticz.Debug("Forced mode On !")
+                _log.Debug("Forced mode On !")
                 self.switchHeat(True)
 
         else:  # Thermostat is in mode auto
@@ -292,7 +833,7 @@ class BasePlugin:
                 self.forced = False
                 self.endheat = now
                 self.nextcalc = now   # this will force a recalculation on next heartbeat
-                Domoticz.Debug("Forced mode Off !")
+                _log.Debug("Forced mode Off !")
                 self.switchHeat(False)
 
             elif (self.endheat <= now or self.pause) and self.heat:  # heat cycle is over
@@ -316,38 +857,80 @@ class BasePlugin:
                     self.switchHeat(False)
 
             elif (self.nextcalc <= now) and not self.pause:  # we start a new calculation
-                self.nextcalc = now + timedelta(minutes=self.calculate_period)
-                self.WriteLog("Next calculation time will be : " + str(self.nextcalc), "Verbose")
+                self.nextcalc = now + timedelta(minutes=self.period)
+                self.WriteLog("Next calculation time will be : {}", "Verbose", self.nextcalc)
 
                 # make current setpoint used in calculation reflect the select mode (10= normal, 20 = economy)
-                if Devices[2].sValue == "10":
-                    self.setpoint = float(Devices[4].sValue)
+                if Devices[self.unit(2)].sValue == "10":
+                    self.setpoint = float(Devices[self.unit(4)].sValue)
                 else:
-                    self.setpoint = float(Devices[5].sValue)
-
-                # call the Domoticz json API for a temperature devices update, to get the lastest temps...
-                if self.readTemps():
-                    # do the thermostat work
-                    self.AutoMode()
-                else:
-                    # make sure we switch off heating if there was an error with reading the temp
-                    self.switchHeat(False)
+                    self.setpoint = float(Devices[self.unit(5)].sValue)
 
-        if self.nexttemps <= now:
-            # call the Domoticz json API for a temperature devices update, to get the lastest temps (and avoid the
-            # connection time out time after 10mins that floods domoticz logs in versions of domoticz since spring 2018)
-            self.readTemps()
+                # the temperatures are then read by the plugin for all zones at once
+                calculate = True
 
         # check if need to refresh setpoints so that they do not turn red in GUI
         if self.nextupdate <= now:
-            self.nextupdate = now + timedelta(minutes=int(Settings["SensorTimeout"]))
-            Devices[4].Update(nValue=0, sValue=Devices[4].sValue)
-            Devices[5].Update(nValue=0, sValue=Devices[5].sValue)
+            self.nextupdate = now + self.plugin.health.timeout
+            Devices[self.unit(4)].Update(nValue=0, sValue=Devices[self.unit(4)].sValue)
+            Devices[self.unit(5)].Update(nValue=0, sValue=Devices[self.unit(5)].sValue)
+
+        return calculate
+
 
+    def nextEvent(self, now):
+        """returns the next time at which onHeartbeat has something to do (None if never)"""
 
+        if not self.devicesok:
+            return None
+        events = [self.nextupdate]
+        mode = Devices[self.unit(1)].sValue
+        if mode == "0":
+            if self.forced or self.heat:
+                events.append(now)
+        elif mode == "20":
+            events.append(self.endheat if self.forced else now)
+        else:
+            if self.forced or (self.pause and self.heat):
+                events.append(now)
+            if self.heat:
+                events.append(self.endheat)
+            if self.pause != self.pauserequested:
+                events.append(self.pauserequestchangedtime +
+                              timedelta(minutes=self.pauseoffdelay if self.pause else self.pauseondelay))
+            elif not self.pause:
+                events.append(self.nextcalc)
+        return min(events)
+
+
+    @timed("AutoMode")
     def AutoMode(self):
 
-        self.WriteLog("Temperatures: Inside = {} / Outside = {}".format(self.intemp, self.outtemp), "Verbose")
+        self.WriteLog("Temperatures: Inside = {} / Outside = {}", "Verbose", self.intemp, self.outtemp)
+
+        # log how long the heaters were actually on during the cycle that ends
+        now = clock()
+        heated = self.heatseconds
+        if self.heaterstart is not None:
+            heated += timedelta.total_seconds(now - self.heaterstart)
+            self.heaterstart = now
+        self.heatseconds = 0
+        elapsed = timedelta.total_seconds(now - self.lastcalc)
+        if self.lastcycle is not None and elapsed > 0:
+            requested = min(elapsed, self.lastcycle[0] * self.period * 60 / 100)
+            self.WriteLog("Last cycle: heated {:.0f} s of the {:.0f} s requested, duty cycle {:.1f}% over {:.0f} s",
+                          "Verbose", heated, requested, 100 * heated / elapsed, elapsed)
+
+        # keep the history of complete cycles for the batch calibration
+        if self.learn and self.lastcycle is not None and elapsed > 0:
+            power, intemp, outtemp = self.lastcycle
+            self.cycles.append((power, intemp, float("nan") if outtemp is None else outtemp,
+                                self.intemp, elapsed / (self.calculate_period * 60)))
+
+        # period of the new cycle, the learning of the cycle that ends being normalised by its own period
+        lastperiod = self.period
+        self.period = self.adaptPeriod(elapsed)
+        self.nextcalc += timedelta(minutes=self.period - lastperiod)  # set at the start of the calculation
 
         if self.intemp > self.setpoint + self.deltamax:
             self.WriteLog("Temperature exceeds setpoint", "Verbose")
@@ -356,13 +939,16 @@ class BasePlugin:
         else:
             overshoot = False
             if self.learn:
-                self.AutoCallib()
+                if not self.BatchCallib():
+                    self.AutoCallib(lastperiod)
             else:
                 self.learn = True
+            # ConstC is the power to close a gap of 1°C over the base period: a shorter cycle needs more power
+            scale = self.calculate_period / self.period
             if self.outtemp is None:
-                power = round((self.setpoint - self.intemp) * self.Internals["ConstC"], 1)
+                power = round((self.setpoint - self.intemp) * self.Internals["ConstC"] * scale, 1)
             else:
-                power = round((self.setpoint - self.intemp) * self.Internals["ConstC"] +
+                power = round((self.setpoint - self.intemp) * self.Internals["ConstC"] * scale +
                               (self.setpoint - self.outtemp) * self.Internals["ConstT"], 1)
 
         if power < 0:
@@ -372,25 +958,27 @@ class BasePlugin:
 
         # apply minimum power as required
         if power <= self.minheatpower and (Parameters["Mode4"] == "Forced" or not overshoot):
-            self.WriteLog(
-                "Calculated power is {}, applying minimum power of {}".format(power, self.minheatpower), "Verbose")
+            self.WriteLog("Calculated power is {}, applying minimum power of {}", "Verbose", power, self.minheatpower)
             power = self.minheatpower
 
         # apply full power if boostt mode and intemp is more than 1°C below setpoint
         if self.boost and (self.setpoint - self.intemp) > self.boostgap:
-            self.WriteLog(
-                "Applying boost mode since current temperature is more than {}°C lower than setpoint".format(self.boostgap), "Verbose")
+            self.WriteLog("Applying boost mode since current temperature is more than {}°C lower than setpoint",
+                          "Verbose", self.boostgap)
             power = 100
 
-        heatduration = round(power * self.calculate_period / 100)
-        self.WriteLog("Calculation: Power = {} -> heat duration = {} minutes".format(power, heatduration), "Verbose")
+        heatduration = round(power * self.period * 60 / 100)  # in seconds
+        self.WriteLog("Calculation: Power = {} -> heat duration = {} seconds", "Verbose", power, heatduration)
+        if self.plugin.archive is not None:
+            self.plugin.archive.add(self.number, now, self.intemp, self.outtemp, self.setpoint, power, heatduration,
+                                    self.period)
 
         if power == 0:
             self.switchHeat(False)
-            Domoticz.Debug("No heating requested !")
+            _log.Debug("No heating requested !")
         else:
-            self.endheat = datetime.now() + timedelta(minutes=heatduration)
-            Domoticz.Debug("End Heat time = " + str(self.endheat))
+            self.endheat = clock() + timedelta(seconds=heatduration)
+            _log.Debug("End Heat time = {}", self.endheat)
             self.switchHeat(True)
             #if self.Internals["ALStatus"] < 2:
             self.Internals['LastPwr'] = power
@@ -399,154 +987,240 @@ class BasePlugin:
             self.Internals['LastSetPoint'] = self.setpoint
             if self.Internals["ALStatus"] != 2:
                 self.Internals['ALStatus'] = 1
-                self.saveUserVar()  # update user variables with latest learning
-
-        self.lastcalc = datetime.now()
+                self.saveInternals()  # update persistent variables with latest learning
+
+        self.lastcycle = (power, self.intemp, self.outtemp)
+        self.lastcalc = clock()
+
+
+    def adaptPeriod(self, elapsed):
+        """returns the period in minutes of the next cycle: the base period, or with AdaptivePeriod a period
+        between PeriodMin and PeriodMax, shorter when the inside temperature is or is heading below the setpoint,
+        and longer when the zone is stable"""
+
+        config = self.plugin.config
+        if not config["AdaptivePeriod"]:
+            return self.calculate_period
+        self.calculations += 1
+        self.calcminutes += elapsed / 60
+        error = self.setpoint - self.intemp  # only a temperature below the setpoint needs a quick reaction
+        trend = 0.  # in °C per hour over the last cycle
+        if self.lastcycle is not None and elapsed > 0:
+            trend = (self.intemp - self.lastcycle[1]) * 3600 / elapsed
+        # the error expected at the end of a base period if the trend goes on
+        expected = error - trend * self.calculate_period / 60
+        # cycles longer than the base period only once the learned constants can be trusted
+        longest = config["PeriodMax"] if self.Internals["nbCC"] >= 10 else min(config["PeriodMax"],
+                                                                                self.calculate_period)
+        shortest = min(config["PeriodMin"], longest)
+        gap = max(error, expected, 0.)
+        period = round(longest - (longest - shortest) * min(1., gap / config["AdaptiveError"]))
+        self.WriteLog("Adaptive period: next calculation in {} minutes (error = {:.1f}°C, trend = {:.1f}°C/h)",
+                      "Verbose", period, error, trend)
+        if clock() >= self.nextsummary:
+            self.summarizePeriods()
+        return period
+
+
+    def summarizePeriods(self):
+
+        # the temperatures are still read every 5 minutes for the sensor timeouts: the calculations saved are
+        # heater switch commands and internals updates saved
+        fixed = self.calcminutes / self.calculate_period
+        self.WriteLog("Adaptive period over the last {:.0f} hours: {} calculations instead of {:.0f} with the fixed "
+                      "period of {} minutes (average period {:.0f} minutes), {} heater switches ({} switch commands)",
+                      "Status", self.calcminutes / 60, self.calculations, fixed, self.calculate_period,
+                      self.calcminutes / max(self.calculations, 1), self.switches, self.switches * len(self.Heaters))
+        self.calculations = self.switches = 0
+        self.calcminutes = 0.
+        self.nextsummary = clock() + timedelta(days=1)
+
+
+    def BatchCallib(self):
+        """refits ConstC and ConstT over the history of cycles, returns False if not possible"""
+
+        if self.plugin.config["Calibration"] != "batch" or numpy is None or self.Internals['ALStatus'] == 2:
+            return False
+        fit = fitConstants(self.cycles, self.Internals['ConstC'], self.plugin.config["CalibrationMinCycles"])
+        if fit is None:
+            _log.Debug("Not enough valid cycles for batch calibration ({} recorded)", len(self.cycles))
+            return False
+        ConstC, ConstT, used = fit
+        self.Internals['ConstC'] = round(ConstC, 1)
+        self.Internals['nbCC'] = min(used, 50)
+        if ConstT is not None:
+            self.Internals['ConstT'] = round(ConstT, 1)
+            self.Internals['nbCT'] = min(used, 50)
+        self.WriteLog("Batch calibration over {} of {} cycles: ConstC = {}, ConstT = {}", "Verbose",
+                      used, len(self.cycles), self.Internals['ConstC'], self.Internals['ConstT'])
+        return True
+
+
+    def checkThreshold(self, now, threshold):
+        """starts a calculation ahead of schedule if a pushed inside temperature crossed the thresholds"""
+
+        if not self.devicesok or Devices[self.unit(1)].sValue != "10" or self.pause or self.intemperror or \
+                self.nextcalc <= now:
+            return
+        if now - self.lastcalc < timedelta(minutes=5):
+            return  # the minimum calculation period
+        if (not self.heat and self.intemp < self.setpoint - threshold) or \
+                (self.heat and self.intemp > self.setpoint + self.deltamax):
+            self.WriteLog("Inside temperature is now {}: recalculating ahead of schedule", "Verbose", self.intemp)
+            self.nextcalc = now
+            self.learn = False
 
 
-    def AutoCallib(self):
+    def AutoCallib(self, period):
+        """incremental learning over the cycle that ends, which lasted 'period' minutes as planned"""
 
-        now = datetime.now()
+        now = clock()
         if self.Internals['ALStatus'] != 1:  # not initalized... do nothing
-            Domoticz.Debug("Fist pass at AutoCallib... no callibration")
+            _log.Debug("Fist pass at AutoCallib... no callibration")
             pass
         elif self.Internals['LastPwr'] == 0:  # heater was off last time, do nothing
-            Domoticz.Debug("Last power was zero... no callibration")
+            _log.Debug("Last power was zero... no callibration")
             pass
         elif self.Internals['LastPwr'] == 100 and self.intemp < self.Internals['LastSetPoint']:
             # heater was on max but setpoint was not reached... no learning
-            Domoticz.Debug("Last power was 100% but setpoint not reached... no callibration")
+            _log.Debug("Last power was 100% but setpoint not reached... no callibration")
             pass
         elif self.intemp > self.Internals['LastInT'] and self.Internals['LastSetPoint'] > self.Internals['LastInT']:
             # learning ConstC
             ConstC = (self.Internals['ConstC'] * ((self.Internals['LastSetPoint'] - self.Internals['LastInT']) /
                                                   (self.intemp - self.Internals['LastInT']) *
-                                                  (timedelta.total_seconds(now - self.lastcalc) /
-                                                   (self.calculate_period * 60))))
-            self.WriteLog("New calc for ConstC = {}".format(ConstC), "Verbose")
+                                                  (timedelta.total_seconds(now - self.lastcalc) / (period * 60))))
+            self.WriteLog("New calc for ConstC = {}", "Verbose", ConstC)
             self.Internals['ConstC'] = round((self.Internals['ConstC'] * self.Internals['nbCC'] + ConstC) /
                                              (self.Internals['nbCC'] + 1), 1)
             self.Internals['nbCC'] = min(self.Internals['nbCC'] + 1, 50)
-            self.WriteLog("ConstC updated to {}".format(self.Internals['ConstC']), "Verbose")
+            self.WriteLog("ConstC updated to {}", "Verbose", self.Internals['ConstC'])
         elif (self.outtemp is not None and self.Internals['LastOutT'] is not None) and \
                  self.Internals['LastSetPoint'] > self.Internals['LastOutT']:
             # learning ConstT
             ConstT = (self.Internals['ConstT'] + ((self.Internals['LastSetPoint'] - self.intemp) /
                                                   (self.Internals['LastSetPoint'] - self.Internals['LastOutT']) *
-                                                  self.Internals['ConstC'] *
-                                                  (timedelta.total_seconds(now - self.lastcalc) /
-                                                   (self.calculate_period * 60))))
-            self.WriteLog("New calc for ConstT = {}".format(ConstT), "Verbose")
+                                                  self.Internals['ConstC'] * self.calculate_period / period *
+                                                  (timedelta.total_seconds(now - self.lastcalc) / (period * 60))))
+            self.WriteLog("New calc for ConstT = {}", "Verbose", ConstT)
             self.Internals['ConstT'] = round((self.Internals['ConstT'] * self.Internals['nbCT'] + ConstT) /
                                              (self.Internals['nbCT'] + 1), 1)
             self.Internals['nbCT'] = min(self.Internals['nbCT'] + 1, 50)
-            self.WriteLog("ConstT updated to {}".format(self.Internals['ConstT']), "Verbose")
+            self.WriteLog("ConstT updated to {}", "Verbose", self.Internals['ConstT'])
 
 
     def switchHeat(self, switch):
 
-        # Build list of heater switches, with their current status,
-        # to be used to check if any of the heaters is already in desired state
-        switches = {}
-        devicesAPI = DomoticzAPI("type=command&param=getdevices&filter=light&used=true&order=Name")
-        if devicesAPI:
-            for device in devicesAPI["result"]:  # parse the switch device
-                idx = int(device["idx"])
-                if idx in self.Heaters:  # this switch is one of our heaters
-                    if "Status" in device:
-                        switches[idx] = True if device["Status"] == "On" else False
-                        Domoticz.Debug("Heater switch {} currently is '{}'".format(idx, device["Status"]))
-                    else:
-                        Domoticz.Error("Device with idx={} does not seem to be a switch !".format(idx))
-
-        # fool proof checking.... based on users feedback
-        if len(switches) == 0:
-            Domoticz.Error("none of the devices in the 'heaters' parameter is a switch... no action !")
-            return
-
-        # flip on / off as needed
+        changed = switch != self.heat
+        if changed:
+            self.switches += 1
         self.heat = switch
-        command = "On" if switch else "Off"
-        Domoticz.Debug("Heating '{}'".format(command))
-        for idx in self.Heaters:
-            if switches[idx] != switch:  # check if action needed
-                DomoticzAPI("type=command&param=switchlight&idx={}&switchcmd={}".format(idx, command))
+        if switch and self.heaterstart is None:
+            self.heaterstart = clock()
+        elif not switch and self.heaterstart is not None:
+            self.heatseconds += timedelta.total_seconds(clock() - self.heaterstart)
+            self.heaterstart = None
+        _log.Debug("Heating '{}'", "On" if switch else "Off")
         if switch:
-            Domoticz.Debug("End Heat time = " + str(self.endheat))
+            _log.Debug("End Heat time = {}", self.endheat)
+        self.plugin.requestHeaters(self.Heaters, switch)
+        if changed:
+            self.recordHistory()
 
 
-    def readTemps(self):
+    def recordHistory(self):
 
-        # set update flag for next temp update
-        self.nexttemps = datetime.now() + timedelta(minutes=5)
+        if self.plugin.history is not None and self.devicesok:
+            power = self.lastcycle[0] if self.lastcycle is not None and Devices[self.unit(1)].sValue != "0" else 0
+            self.plugin.history.add(self.number, self.intemp, self.outtemp, self.setpoint, power, self.heat)
+
+
+    def onTemps(self, devices, calculate):
+
+        if not self.devicesok:
+            return
 
-        # fetch all the devices from the API and scan for sensors
         noerror = True
-        listintemps = []
-        listouttemps = []
-        devicesAPI = DomoticzAPI("type=command&param=getdevices&filter=temp&used=true&order=Name")
-        if devicesAPI:
-            for device in devicesAPI["result"]:  # parse the devices for temperature sensors
-                idx = int(device["idx"])
-                if idx in self.InTempSensors:
-                    if "Temp" in device:
-                        Domoticz.Debug("device: {}-{} = {}".format(device["idx"], device["Name"], device["Temp"]))
-                        # check temp sensor is not timed out
-                        if not self.SensorTimedOut(idx, device["Name"], device["LastUpdate"]):
-                            listintemps.append(device["Temp"])
-                    else:
-                        Domoticz.Error("device: {}-{} is not a Temperature sensor".format(device["idx"], device["Name"]))
-                elif idx in self.OutTempSensors:
-                    if "Temp" in device:
-                        Domoticz.Debug("device: {}-{} = {}".format(device["idx"], device["Name"], device["Temp"]))
-                        # check temp sensor is not timed out
-                        if not self.SensorTimedOut(idx, device["Name"], device["LastUpdate"]):
-                            listouttemps.append(device["Temp"])
-                    else:
-                        Domoticz.Error("device: {}-{} is not a Temperature sensor".format(device["idx"], device["Name"]))
-
-        # calculate the average inside temperature
-        nbtemps = len(listintemps)
-        if nbtemps > 0:
-            self.intemp = round(sum(listintemps) / nbtemps, 1)
+        for idx in itertools.chain(self.InTempSensors, self.OutTempSensors):
+            device = devices.get(idx)
+            if device is not None and "Temp" not in device:
+                _log.Error("device: {}-{} is not a Temperature sensor", device["idx"], device["Name"])
+
+        # calculate the average inside temperature, from the sensors that are not timed out
+        intemp = self.plugin.health.aggregate(self.InTempSensors)
+        if intemp is not None:
+            self.intemp = round(intemp, 1)
             # update the dummy device showing the current thermostat temp
-            Devices[6].Update(nValue=0, sValue=str(self.intemp), TimedOut=False)
+            Devices[self.unit(6)].Update(nValue=0, sValue=str(self.intemp), TimedOut=False)
             if self.intemperror:  # there was previously an invalid inside temperature reading... reset to normal
                 self.intemperror = False
                 self.WriteLog("Inside Temperature reading is now valid again: Resuming normal operation", "Status")
                 # we remove the timedout flag on the thermostat switch
-                Devices[1].Update(nValue=Devices[1].nValue, sValue=Devices[1].sValue, TimedOut=False)
+                device = Devices[self.unit(1)]
+                device.Update(nValue=device.nValue, sValue=device.sValue, TimedOut=False)
         else:
             # no valid inside temperature
             noerror = False
             if not self.intemperror:
                 self.intemperror = True
-                Domoticz.Error("No Inside Temperature found: Switching heating Off")
+                _log.Error("No Inside Temperature found: Switching heating Off")
                 self.switchHeat(False)
                 # we mark both the thermostat switch and the thermostat temp devices as timedout
-                Devices[1].Update(nValue=Devices[1].nValue, sValue=Devices[1].sValue, TimedOut=True)
-                Devices[6].Update(nValue=Devices[6].nValue, sValue=Devices[6].sValue, TimedOut=True)
+                for device in (Devices[self.unit(1)], Devices[self.unit(6)]):
+                    device.Update(nValue=device.nValue, sValue=device.sValue, TimedOut=True)
 
         # calculate the average outside temperature
-        nbtemps = len(listouttemps)
-        if nbtemps > 0:
-            self.outtemp = round(sum(listouttemps) / nbtemps, 1)
+        outtemp = self.plugin.health.aggregate(self.OutTempSensors)
+        if outtemp is not None:
+            self.outtemp = round(outtemp, 1)
         else:
-            Domoticz.Debug("No Outside Temperature found...")
+            _log.Debug("No Outside Temperature found...")
             self.outtemp = None
 
-        Domoticz.Debug("Inside Temperature = {}".format(self.intemp))
-        Domoticz.Debug("Outside Temperature = {}".format(self.outtemp))
-        return noerror
+        _log.Debug("Inside Temperature = {}", self.intemp)
+        _log.Debug("Outside Temperature = {}", self.outtemp)
 
+        if calculate:
+            if noerror:
+                # do the thermostat work
+                self.AutoMode()
+            else:
+                # make sure we switch off heating if there was an error with reading the temp
+                self.switchHeat(False)
+        self.recordHistory()
 
-    def getUserVar(self):
 
-        variables = DomoticzAPI("type=command&param=getuservariables")
+    def name(self):
+
+        return Parameters["Name"] if self.number == 1 else "{} zone {}".format(Parameters["Name"], self.number)
+
+
+    def varName(self):
+
+        if self.number == 1:
+            return Parameters["Name"] + "-InternalVariables"
+        return Parameters["Name"] + "-Zone{}-InternalVariables".format(self.number)
+
+
+    def restore(self, record):
+        """restores the learning from the local file record of the zone, returns False if there is none"""
+
+        if not record:
+            return False
+        self.Internals.update(sanitizeInternals(record.get("Internals", {}), self.InternalsDefaults))
+        cycles = record.get("cycles")
+        if isinstance(cycles, list):
+            self.cycles.extend(cycle for cycle in map(sanitizeCycle, cycles) if cycle is not None)
+        self.WriteLog("Learning restored: {}", "Verbose", self.Internals)
+        return True
+
+
+    def onUserVar(self, variables, restore):
+
         if variables:
             # there is a valid response from the API but we do not know if our variable exists yet
             novar = True
-            varname = Parameters["Name"] + "-InternalVariables"
+            varname = self.varName()
             valuestring = ""
             if "result" in variables:
                 for variable in variables["result"]:
@@ -555,62 +1229,90 @@ class BasePlugin:
                         novar = False
                         break
             if novar:
-                # create user variable since it does not exist
-                self.WriteLog("User Variable {} does not exist. Creating it.".format(varname), "Verbose")
-                # actually calling Domoticz API
-                DomoticzAPI("type=command&param=adduservariable&vname={}&vtype=2&vvalue={}".format(
-                    varname, str(self.InternalsDefaults)))
-                self.Internals = self.InternalsDefaults.copy()  # we re-initialize the internal variables
-            else:
+                if restore:
+                    self.Internals = self.InternalsDefaults.copy()  # we re-initialize the internal variables
+                if self.plugin.config["MirrorUserVariable"]:
+                    # create user variable since it does not exist
+                    self.WriteLog("User Variable {} does not exist. Creating it.", "Verbose", varname)
+                    # actually calling Domoticz API
+                    APICall = "type=command&param=adduservariable&vname={}&vtype=2&vvalue={}".format(
+                        varname, str(self.Internals))
+                    self.plugin.worker.submit(lambda: DomoticzAPI(APICall))
+            elif restore:
                 try:
-                    self.Internals.update(eval(valuestring))
-                except:
+                    self.Internals.update(sanitizeInternals(ast.literal_eval(valuestring), self.InternalsDefaults))
+                    self.WriteLog("Learning recovered from user variable {}", "Status", varname)
+                except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
                     self.Internals = self.InternalsDefaults.copy()
-                return
-        else:
-            Domoticz.Error("Cannot read the uservariable holding the persistent variables")
+            if restore:
+                self.saveInternals()
+        elif restore:
+            _log.Error("Cannot read the uservariable holding the persistent variables")
             self.Internals = self.InternalsDefaults.copy()
 
 
-    def saveUserVar(self):
+    def transition(self):
 
-        varname = Parameters["Name"] + "-InternalVariables"
-        DomoticzAPI("type=command&param=updateuservariable&vname={}&vtype=2&vvalue={}".format(
-            varname, str(self.Internals)))
+        return self.heat, self.forced, self.pause
 
 
-    def WriteLog(self, message, level="Normal"):
-
-        if (self.loglevel == "Verbose" and level == "Verbose") or level == "Status":
-            Domoticz.Status(message)
-        elif level == "Normal":
-            Domoticz.Log(message)
+    def runtime(self):
 
+        return {"setup": [self.InTempSensors, self.OutTempSensors, self.Heaters],
+                "mode": Devices[self.unit(1)].sValue if self.devicesok else None,
+                "heat": self.heat, "forced": self.forced, "pause": self.pause, "pauserequested": self.pauserequested,
+                "pausechanged": timeToStr(self.pauserequestchangedtime), "endheat": timeToStr(self.endheat),
+                "nextcalc": timeToStr(self.nextcalc), "lastcalc": timeToStr(self.lastcalc),
+                "intemp": self.intemp, "outtemp": self.outtemp, "setpoint": self.setpoint, "learn": self.learn,
+                "lastcycle": self.lastcycle, "heaterstart": timeToStr(self.heaterstart),
+                "heatseconds": round(self.heatseconds, 1), "period": self.period}
 
-    def SensorTimedOut(self, idx, name, datestring):
 
-        def LastUpdate(datestring):
-            dateformat = "%Y-%m-%d %H:%M:%S"
-            # the below try/except is meant to address an intermittent python bug in some embedded systems
-            try:
-                result = datetime.strptime(datestring, dateformat)
-            except TypeError:
-                result = datetime(*(time.strptime(datestring, dateformat)[0:6]))
-            return result
-
-        timedout = LastUpdate(datestring) + timedelta(minutes=int(Settings["SensorTimeout"])) < datetime.now()
-
-        # handle logging of time outs... only log when status changes (less clutter in logs)
-        if timedout:
-            if self.ActiveSensors[idx]:
-                Domoticz.Error("skipping timed out temperature sensor '{}'".format(name))
-                self.ActiveSensors[idx] = False
-        else:
-            if not self.ActiveSensors[idx]:
-                self.WriteLog("previously timed out temperature sensor '{}' is back online".format(name), "Status")
-                self.ActiveSensors[idx] = True
+    def resume(self, record):
+        """restores the state of the zone saved by runtime(), returns False if not possible"""
 
-        return timedout
+        if not record or not self.devicesok or \
+                record.get("setup") != [self.InTempSensors, self.OutTempSensors, self.Heaters] or \
+                record.get("mode") != Devices[self.unit(1)].sValue:
+            return False  # the configuration or the mode were changed meanwhile
+        try:
+            state = {"endheat": strToTime(record["endheat"]), "nextcalc": strToTime(record["nextcalc"]),
+                     "lastcalc": strToTime(record["lastcalc"]),
+                     "pauserequestchangedtime": strToTime(record["pausechanged"]),
+                     "heaterstart": strToTime(record["heaterstart"]), "heatseconds": float(record["heatseconds"]),
+                     "heat": bool(record["heat"]), "forced": bool(record["forced"]), "pause": bool(record["pause"]),
+                     "pauserequested": bool(record["pauserequested"]), "intemp": float(record["intemp"]),
+                     "outtemp": None if record["outtemp"] is None else float(record["outtemp"]),
+                     "setpoint": float(record["setpoint"]), "learn": bool(record["learn"]),
+                     "lastcycle": None if record["lastcycle"] is None else tuple(record["lastcycle"]),
+                     "period": int(record.get("period", self.calculate_period))}
+        except (KeyError, ValueError, TypeError):
+            return False
+        if None in (state["endheat"], state["nextcalc"], state["lastcalc"], state["pauserequestchangedtime"]):
+            return False
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.WriteLog("Resumed: heat = {}, end heat = {}, next calculation = {}", "Verbose",
+                      self.heat, self.endheat, self.nextcalc)
+        return True
+
+
+    def saveInternals(self):
+
+        self.plugin.store.update(str(self.number), {
+            "Internals": self.Internals,
+            "cycles": [[round(value, 3) for value in cycle] for cycle in self.cycles]})
+        if self.plugin.config["MirrorUserVariable"]:
+            APICall = "type=command&param=updateuservariable&vname={}&vtype=2&vvalue={}".format(
+                self.varName(), str(self.Internals))
+            self.plugin.worker.submit(lambda: DomoticzAPI(APICall))
+
+
+    def WriteLog(self, message, level="Normal", *args):
+
+        if self.number > 1:
+            message = "Zone {}: ".format(self.number) + message
+        _log.Write(level, message, *args)
 
 
 global _plugin
@@ -632,6 +1334,26 @@ def onCommand(Unit, Command, Level, Color):
     _plugin.onCommand(Unit, Command, Level, Color)
 
 
+def onConnect(Connection, Status, Description):
+    global _plugin
+    _plugin.onConnect(Connection, Status, Description)
+
+
+def onMessage(Connection, Data):
+    global _plugin
+    _plugin.onMessage(Connection, Data)
+
+
+def onDisconnect(Connection):
+    global _plugin
+    _plugin.onDisconnect(Connection)
+
+
+def onDeviceRemoved(Unit):
+    global _plugin
+    _plugin.onDeviceRemoved(Unit)
+
+
 def onHeartbeat():
     global _plugin
     _plugin.onHeartbeat()
@@ -657,40 +1379,1671 @@ def parseCSV(strCSV):
     return listvals
 
 
-def DomoticzAPI(APICall):
+class PersistentStore:
+    """Local json file holding the learned internals of the zones. Updates are kept in memory and written
+    (atomically) at most every 'interval' minutes, and when the plugin stops"""
 
-    resultJson = None
-    url = "http://{}:{}/json.htm?{}".format(Parameters["Address"], Parameters["Port"], parse.quote(APICall, safe="&="))
-    Domoticz.Debug("Calling domoticz API: {}".format(url))
-    try:
-        req = request.Request(url)
-        if Parameters["Username"] != "":
-            Domoticz.Debug("Add authentification for user {}".format(Parameters["Username"]))
-            credentials = ('%s:%s' % (Parameters["Username"], Parameters["Password"]))
+    SCHEMA = 1  # version of the file format
+
+    def __init__(self, filename, interval):
+        self.filename = filename
+        self.interval = timedelta(minutes=interval)
+        self.data = {}
+        self.runtime = {}  # state of the thermostats to resume after a restart
+        self.dirty = False
+        self.nextflush = clock()
+
+    def load(self):
+
+        try:
+            with open(self.filename) as file:
+                content = json.load(file)
+            if content.get("schema") != self.SCHEMA:
+                _log.Error("Unsupported format version of {}: ignored", self.filename)
+            else:
+                self.data = content.get("zones", {})
+                self.runtime = content.get("runtime", {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as error:
+            _log.Error("Error reading {}: {}", self.filename, error)
+        return self.data
+
+    def update(self, key, value):
+
+        self.data[key] = value
+        self.dirty = True
+
+    def updateRuntime(self, runtime):
+
+        if runtime != {key: value for key, value in self.runtime.items() if key != "saved"}:
+            self.runtime = runtime
+            self.dirty = True
+
+    def flush(self, force=False):
+
+        now = clock()
+        if not self.dirty or (now < self.nextflush and not force):
+            return
+        self.nextflush = now + self.interval
+        temporary = self.filename + ".tmp"
+        try:
+            with open(temporary, "w") as file:
+                self.runtime["saved"] = timeToStr(now)
+                json.dump({"schema": self.SCHEMA, "zones": self.data, "runtime": self.runtime}, file,
+                          separators=(",", ":"))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.filename)
+            self.dirty = False
+            _log.Debug("Internals saved to {}", self.filename)
+        except OSError as error:
+            _log.Error("Error writing {}: {}", self.filename, error)
+
+
+Cycle = collections.namedtuple("Cycle", "time zone daily intemp outtemp setpoint power heat period")
+
+
+class CycleArchive:
+    """History of the calculation cycles of the zones. The last 'size' cycles are kept in memory in a ring buffer
+    of packed fixed-width records, spilled at most every 'interval' minutes to an append-only binary file, which
+    is read back by time range through mmap and a binary search. Once a day, the cycles older than 'days' days
+    are downsampled to one record per zone and day, which replace them at the start of the file"""
+
+    # time (UTC seconds since the epoch, never decreasing), zone, flags, inside / outside temperature and setpoint
+    # (1/100 °C), power (1/10 %), heat (seconds), period (minutes; for a daily record, the minutes of its cycles)
+    RECORD = struct.Struct("<IBBhhhHIH")
+    TIME = struct.Struct("<I")
+    DAILY = 1  # flag of the downsampled records
+    NOTEMP = -32768  # no outside temperature
+
+    def __init__(self, filename, size, days, interval):
+        self.filename = filename
+        self.days = days
+        self.interval = timedelta(minutes=interval)
+        self.size = max(size, 1)
+        self.ring = bytearray(self.RECORD.size * self.size)
+        self.head = 0  # index of the next record in the ring
+        self.count = 0  # records in the ring
+        self.unsaved = 0  # most recent records of the ring not yet in the file
+        self.nextspill = clock() + self.interval
+        self.nextcompact = clock()
+        self.last = self.repair(self.filename)  # time of the last record
+
+    @staticmethod
+    def epoch(when):
+        """UTC seconds since the epoch of a datetime of the plugin clock (local time, its DST fold included)"""
+
+        return int(when.astimezone(timezone.utc).timestamp())
+
+    def add(self, zone, when, intemp, outtemp, setpoint, power, heat, period):
+
+        if self.unsaved == self.size:
+            self.spill(force=True)  # else the oldest unsaved record would be overwritten
+        # the records stay in time order for the binary search, even if the clock goes back
+        self.last = max(self.epoch(when), self.last)
+        self.RECORD.pack_into(self.ring, self.head * self.RECORD.size, *self.encode(
+            Cycle(self.last, zone, False, intemp, outtemp, setpoint, power, heat, period)))
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.unsaved += 1
+
+    def encode(self, cycle):
+
+        return (cycle.time, cycle.zone, self.DAILY if cycle.daily else 0, round(cycle.intemp * 100),
+                self.NOTEMP if cycle.outtemp is None else round(cycle.outtemp * 100), round(cycle.setpoint * 100),
+                round(cycle.power * 10), min(round(cycle.heat), 0xFFFFFFFF), min(round(cycle.period), 0xFFFF))
+
+    def decode(self, values):
+
+        when, zone, flags, intemp, outtemp, setpoint, power, heat, period = values
+        return Cycle(when, zone, bool(flags & self.DAILY), intemp / 100, None if outtemp == self.NOTEMP else
+                     outtemp / 100, setpoint / 100, power / 10, heat, period)
+
+    def recent(self, count=None):
+        """returns the last 'count' (by default all the) cycles of the ring buffer, oldest first"""
+
+        count = self.count if count is None else min(count, self.count)
+        return [self.decode(self.RECORD.unpack_from(self.ring, (index % self.size) * self.RECORD.size))
+                for index in range(self.head - count, self.head)]
+
+    def read(self, start, end, zone=None):
+        """returns the cycles between the datetimes start and end: daily records, then detailed ones"""
+
+        start, end = self.epoch(start), self.epoch(end)
+        cycles = self.readFile(self.filename, start, end)
+        cycles.extend(cycle for cycle in self.recent(self.unsaved) if start <= cycle.time <= end)
+        return [cycle for cycle in cycles if zone is None or cycle.zone == zone]
+
+    def readFile(self, filename, start, end):
+
+        try:
+            with open(filename, "rb") as file:
+                count = os.fstat(file.fileno()).st_size // self.RECORD.size
+                if count == 0:
+                    return []
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                    first = self.search(view, count, start)
+                    last = self.search(view, count, end + 1)
+                    return [self.decode(self.RECORD.unpack_from(view, index * self.RECORD.size))
+                            for index in range(first, last)]
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as error:
+            _log.Error("Error reading {}: {}", filename, error)
+            return []
+
+    def search(self, view, count, when):
+        """index of the first record of the view at or after the time 'when' (the records are in time order)"""
+
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self.TIME.unpack_from(view, middle * self.RECORD.size)[0] < when:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def repair(self, filename):
+        """drops a partial record left by an interrupted write, so that the next ones stay aligned, and returns
+        the time of the last record (0 if none)"""
+
+        try:
+            with open(filename, "r+b") as file:
+                size = os.fstat(file.fileno()).st_size
+                if size % self.RECORD.size:
+                    size -= size % self.RECORD.size
+                    file.truncate(size)
+                if size == 0:
+                    return 0
+                file.seek(size - self.RECORD.size)
+                return self.TIME.unpack(file.read(self.TIME.size))[0]
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            _log.Error("Error checking {}: {}", filename, error)
+        return 0
+
+    def spill(self, force=False):
+
+        now = clock()
+        if self.unsaved and (force or now >= self.nextspill):
+            self.nextspill = now + self.interval
+            try:
+                with open(self.filename, "ab") as file:
+                    for index in range(self.head - self.unsaved, self.head):
+                        start = (index % self.size) * self.RECORD.size
+                        file.write(self.ring[start:start + self.RECORD.size])
+                self.unsaved = 0
+            except OSError as error:
+                _log.Error("Error writing {}: {}", self.filename, error)
+        if now >= self.nextcompact and not self.unsaved:
+            self.nextcompact = now + timedelta(days=1)
+            self.compact(now)
+
+    def compact(self, now):
+        """replaces the cycles older than 'days' days by one record per zone and day"""
+
+        # cycles of the days before the limit day (at local midnight)
+        limit = datetime.combine((now - timedelta(days=self.days)).date(), datetime.min.time())
+        old = self.readFile(self.filename, 0, self.epoch(limit) - 1)
+        detailed = [cycle for cycle in old if not cycle.daily]
+        if not detailed:
+            return
+        days = {}
+        for cycle in detailed:
+            day = datetime.combine(datetime.fromtimestamp(cycle.time).date(), datetime.min.time())
+            days.setdefault((day, cycle.zone), []).append(cycle)
+        records = []
+        for (day, zone), cycles in sorted(days.items()):
+            outtemps = [cycle.outtemp for cycle in cycles if cycle.outtemp is not None]
+            records.append(self.RECORD.pack(*self.encode(Cycle(
+                self.epoch(day), zone, True, sum(cycle.intemp for cycle in cycles) / len(cycles),
+                sum(outtemps) / len(outtemps) if outtemps else None,
+                sum(cycle.setpoint for cycle in cycles) / len(cycles),
+                sum(cycle.power for cycle in cycles) / len(cycles), sum(cycle.heat for cycle in cycles),
+                min(sum(cycle.period for cycle in cycles), 1440)))))
+        # the daily records of the previous compactions, the new ones, then the recent cycles, replaced in one step
+        temporary = self.filename + ".tmp"
+        try:
+            with open(self.filename, "rb") as file:
+                previous = file.read(len(old) * self.RECORD.size)
+                recent = file.read()
+            with open(temporary, "wb") as file:
+                for index, cycle in enumerate(old):
+                    if cycle.daily:
+                        file.write(previous[index * self.RECORD.size:(index + 1) * self.RECORD.size])
+                file.write(b"".join(records))
+                file.write(recent)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.filename)
+            _log.Debug("Cycle archive: {} cycles downsampled to {} daily records", len(detailed), len(records))
+        except OSError as error:
+            _log.Error("Error compacting {}: {}", self.filename, error)
+
+
+class History:
+    """Downsampled history of the zones (temperatures, setpoint, power and heating) published as one json file
+    for the SVT viewer. Samples in the same 'step' minutes are merged unless the heating changed, samples older
+    than 'days' are dropped, and the file is written at most every 'interval' minutes. The file is shared by all
+    the SVT hardware of Domoticz: each instance replaces its own entry under a file lock"""
+
+    COLUMNS = ("time", "in", "out", "setpoint", "power", "heat")  # time in seconds since the epoch
+
+    def __init__(self, filename, key, step, days, interval):
+        self.filename = filename
+        self.key = key  # hardware id of the plugin instance
+        self.step = step * 60
+        self.days = days
+        self.interval = timedelta(minutes=interval)
+        self.zones = {}  # {zone number: {"name": name, "samples": deque of samples as per COLUMNS}}
+        self.dirty = False
+        self.nextwrite = clock()
+
+    def load(self, names):
+        """restores the samples of the zones {number: name} from the file"""
+
+        try:
+            with open(self.filename) as file:
+                entry = json.load(file)["thermostats"][self.key]
+            for number, zone in entry["zones"].items():
+                if int(number) in names:
+                    self.zones[int(number)] = {"name": names[int(number)],
+                                               "samples": collections.deque(zone["samples"])}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+        for number, name in names.items():
+            self.zones.setdefault(number, {"name": name, "samples": collections.deque()})
+
+    def add(self, number, intemp, outtemp, setpoint, power, heat):
+
+        now = int(clock().timestamp())
+        samples = self.zones[number]["samples"]
+        sample = [now, intemp, outtemp, setpoint, power, int(heat)]
+        if samples and samples[-1][0] // self.step == now // self.step and samples[-1][5] == sample[5]:
+            samples[-1] = sample
+        else:
+            samples.append(sample)
+        while samples[0][0] < now - self.days * 86400:
+            samples.popleft()
+        self.dirty = True
+
+    def write(self, force=False):
+
+        now = clock()
+        if not self.dirty or (now < self.nextwrite and not force):
+            return
+        self.nextwrite = now + self.interval
+        entry = {"updated": timeToStr(now), "columns": self.COLUMNS,
+                 "zones": {str(number): {"name": zone["name"], "samples": list(zone["samples"])}
+                           for number, zone in self.zones.items()}}
+        temporary = "{}.{}.tmp".format(self.filename, self.key)
+        try:
+            with open(self.filename + ".lock", "w") as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                # keep the entries of the other instances
+                try:
+                    with open(self.filename) as file:
+                        content = json.load(file)
+                    content["thermostats"][self.key] = entry
+                except (OSError, ValueError, KeyError, TypeError):
+                    content = {"thermostats": {self.key: entry}}
+                with open(temporary, "w") as file:
+                    json.dump(content, file, separators=(",", ":"))
+                os.replace(temporary, self.filename)
+            self.dirty = False
+            _log.Debug("History written to {}", self.filename)
+        except OSError as error:
+            _log.Error("Error writing {}: {}", self.filename, error)
+
+
+def sanitizeInternals(values, defaults):
+    """keeps only the known internals with a numerical value (LastOutT may also be None)"""
+
+    if not isinstance(values, dict):
+        raise TypeError("internals must be a dict")
+    return {name: value for name, value in values.items() if name in defaults and
+            (value is None or (type(value) in (int, float) and value == value))}
+
+
+def sanitizeCycle(cycle):
+    """returns a cycle of the batch calibration history read from a file as a tuple, or None if it is not valid
+    (power, inside temp, outside temp or nan, end inside temp, duration > 0)"""
+
+    if not isinstance(cycle, (list, tuple)) or len(cycle) != 5 or \
+            any(type(value) not in (int, float) for value in cycle):
+        return None
+    power, intemp, outtemp, endtemp, duration = (float(value) for value in cycle)
+    if not (0 <= power <= 100 and math.isfinite(intemp) and math.isfinite(endtemp) and not math.isinf(outtemp) and
+            0 < duration < math.inf):
+        return None
+    return power, intemp, outtemp, endtemp, duration
+
+
+class TempSubscriber:
+    """Keeps a table of the temperatures of our sensors, updated by the messages that Domoticz pushes on its
+    MQTT output, using the MQTT protocol of the Domoticz plugin framework. The table has the same format as
+    the devices returned by the getdevices API, and is only used once it has a baseline from the API"""
+
+    def __init__(self, address, port, topic, sensors, timeout):
+        self.address = address
+        self.port = port
+        self.topic = topic
+        self.sensors = set(sensors)
+        self.timeout = timedelta(minutes=timeout)  # no message received for that long = fall back to polling
+        self.connection = None
+        self.subscribed = False
+        self.temps = {}  # {idx: device}
+        self.updated = set()  # idx of the sensors updated since last consumed by the plugin
+        self.lastmessage = None
+        self.nextping = clock()
+
+    def connect(self):
+
+        self.subscribed = False
+        self.connection = Domoticz.Connection(Name="SVT MQTT", Transport="TCP/IP", Protocol="MQTT",
+                                              Address=self.address, Port=str(self.port))
+        self.connection.Connect()
+
+    def disconnect(self):
+
+        if self.connection is not None and (self.connection.Connected() or self.connection.Connecting()):
+            self.connection.Disconnect()
+        self.connection = None
+
+    def active(self, now):
+
+        return self.subscribed and bool(self.temps) and self.lastmessage is not None and \
+            now - self.lastmessage < self.timeout
+
+    def baseline(self, devices):
+
+        for idx, device in devices.items():
+            if idx in self.sensors and "Temp" in device and idx not in self.temps:
+                self.temps[idx] = {"idx": device["idx"], "Name": device["Name"], "Temp": device["Temp"],
+                                   "LastUpdate": device["LastUpdate"]}
+
+    def onConnect(self, Connection, Status, Description):
+
+        if Status == 0:
+            _log.Debug("Connected to MQTT broker {}:{}", self.address, self.port)
+            Connection.Send({"Verb": "CONNECT", "ID": "SVT_{}".format(Parameters["HardwareID"])})
+        else:
+            _log.Error("Cannot connect to MQTT broker {}:{}: {}", self.address, self.port, Description)
+
+    def onMessage(self, Connection, Data):
+
+        verb = Data.get("Verb")
+        if verb == "CONNACK":
+            Connection.Send({"Verb": "SUBSCRIBE", "PacketIdentifier": 1001,
+                             "Topics": [{"Topic": self.topic, "QoS": 0}, {"Topic": self.topic + "/#", "QoS": 0}]})
+        elif verb == "SUBACK":
+            self.subscribed = True
+            self.lastmessage = clock()
+            Domoticz.Status("Subscribed to the temperatures pushed on MQTT topic '{}'".format(self.topic))
+        elif verb == "PUBLISH":
+            self.lastmessage = clock()
+            payload = Data.get("Payload", b"")
+            try:
+                message = json.loads(payload.decode("utf-8") if isinstance(payload, bytes) else payload)
+                idx = int(message["idx"])
+                if idx not in self.sensors or not str(message.get("dtype", "")).startswith("Temp"):
+                    return
+                temp = float(message["svalue1"])
+            except (ValueError, KeyError, TypeError):
+                return
+            device = self.temps.get(idx)
+            if device is not None:
+                device["Temp"] = temp
+                device["LastUpdate"] = self.lastmessage.strftime("%Y-%m-%d %H:%M:%S")
+                self.updated.add(idx)
+
+    def onDisconnect(self, Connection):
+
+        _log.Debug("Disconnected from MQTT broker: temperatures are now polled")
+        self.subscribed = False
+
+    def onHeartbeat(self, now):
+
+        if self.connection is None or now < self.nextping:
+            return
+        self.nextping = now + timedelta(seconds=30)
+        if self.connection.Connected():
+            self.connection.Send({"Verb": "PING"})
+        elif not self.connection.Connecting():
+            self.connect()
+
+
+class PluginLog:
+    """Logging of the plugin, where messages are given with their arguments as for str.format() and only
+    formatted when actually written. The debug and verbose messages that are not written are kept in a ring buffer
+    (with a copy of their arguments, formatted later) and dumped to the log when an error occurs, as its context"""
+
+    def __init__(self, size=200):
+        self.debug = False
+        self.verbose = False
+        self.buffer = collections.deque(maxlen=size)  # (time, message, arguments)
+        self.lock = threading.Lock()
+
+    def setup(self, debug, verbose, size):
+
+        self.debug = debug
+        self.verbose = verbose
+        self.buffer = collections.deque(maxlen=size)
+
+    @staticmethod
+    def format(message, args):
+
+        return message.format(*args) if args else message
+
+    def keep(self, message, args):
+
+        if self.buffer.maxlen:
+            # the containers are copied so that the dump shows their content at the time of the message
+            args = tuple(arg.copy() if isinstance(arg, (dict, list, set)) else arg for arg in args)
+            with self.lock:
+                self.buffer.append((clock(), message, args))
+
+    def Debug(self, message, *args):
+
+        if self.debug:
+            Domoticz.Debug(self.format(message, args))
+        else:
+            self.keep(message, args)
+
+    def Write(self, level, message, *args):
+
+        if level == "Status" or (level == "Verbose" and self.verbose):
+            Domoticz.Status(self.format(message, args))
+        elif level == "Normal":
+            Domoticz.Log(self.format(message, args))
+        else:
+            self.keep(message, args)
+
+    def Error(self, message, *args):
+
+        Domoticz.Error(self.format(message, args))
+        with self.lock:
+            records = list(self.buffer)
+            self.buffer.clear()
+        if records:
+            Domoticz.Log("Last {} debug messages before this error:".format(len(records)))
+            for when, message, args in records:
+                try:
+                    Domoticz.Log("  {} {}".format(when.strftime("%H:%M:%S"), self.format(message, args)))
+                except (ValueError, IndexError, KeyError, AttributeError):
+                    Domoticz.Log("  {} {} {}".format(when.strftime("%H:%M:%S"), message, args))
+
+
+_log = PluginLog()
+
+
+class Metrics:
+    """Counters and timings of the plugin: execution time of its main methods, latency histogram, errors and
+    bytes of the API calls per endpoint, and number of switches per heater. Updated from the worker threads too"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # upper bounds in seconds of the histogram
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}  # {name: [count, total seconds, max seconds]}
+        self.api = {}  # {endpoint: {"count", "errors", "bytes", "seconds", "buckets" (count per upper bound)}}
+        self.switches = {}  # {heater idx: number of switches}
+
+    @contextlib.contextmanager
+    def timer(self, name):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                timing = self.timings.setdefault(name, [0, 0., 0.])
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+
+    def apiCall(self, APICall, seconds, nbytes, error):
+
+        params = dict(part.split("=", 1) for part in APICall.split("&") if "=" in part)
+        endpoint = params.get("param", params.get("type", "unknown"))
+        with self.lock:
+            api = self.api.get(endpoint)
+            if api is None:
+                api = self.api[endpoint] = {"count": 0, "errors": 0, "bytes": 0, "seconds": 0.,
+                                            "buckets": [0] * (len(self.BUCKETS) + 1)}
+            api["count"] += 1
+            api["errors"] += 1 if error else 0
+            api["bytes"] += nbytes
+            api["seconds"] += seconds
+            api["buckets"][next((i for i, bound in enumerate(self.BUCKETS) if seconds <= bound),
+                                len(self.BUCKETS))] += 1
+
+    def switched(self, changed):
+
+        with self.lock:
+            for idx in changed:
+                self.switches[idx] = self.switches.get(idx, 0) + 1
+
+    def snapshot(self):
+
+        with self.lock:
+            return {"timings": {name: {"count": count, "seconds": round(total, 6), "max": round(maximum, 6)}
+                                for name, (count, total, maximum) in self.timings.items()},
+                    "api": {endpoint: dict(api, seconds=round(api["seconds"], 6), buckets=list(api["buckets"]))
+                            for endpoint, api in self.api.items()},
+                    "switches": dict(self.switches)}
+
+    def prometheus(self, snapshot, gauges):
+
+        lines = ["# TYPE svt_function_seconds summary"]
+        for name, timing in sorted(snapshot["timings"].items()):
+            lines.append('svt_function_seconds_count{{function="{}"}} {}'.format(name, timing["count"]))
+            lines.append('svt_function_seconds_sum{{function="{}"}} {}'.format(name, timing["seconds"]))
+        lines.append("# TYPE svt_function_max_seconds gauge")
+        for name, timing in sorted(snapshot["timings"].items()):
+            lines.append('svt_function_max_seconds{{function="{}"}} {}'.format(name, timing["max"]))
+        lines.append("# TYPE svt_api_request_seconds histogram")
+        for endpoint, api in sorted(snapshot["api"].items()):
+            cumulated = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), api["buckets"]):
+                cumulated += count
+                lines.append('svt_api_request_seconds_bucket{{endpoint="{}",le="{}"}} {}'.format(
+                    endpoint, bound, cumulated))
+            lines.append('svt_api_request_seconds_sum{{endpoint="{}"}} {}'.format(endpoint, api["seconds"]))
+            lines.append('svt_api_request_seconds_count{{endpoint="{}"}} {}'.format(endpoint, api["count"]))
+        for metric, key in (("svt_api_errors_total", "errors"), ("svt_api_bytes_total", "bytes")):
+            lines.append("# TYPE {} counter".format(metric))
+            for endpoint, api in sorted(snapshot["api"].items()):
+                lines.append('{}{{endpoint="{}"}} {}'.format(metric, endpoint, api[key]))
+        lines.append("# TYPE svt_heater_switches_total counter")
+        for idx, count in sorted(snapshot["switches"].items()):
+            lines.append('svt_heater_switches_total{{idx="{}"}} {}'.format(idx, count))
+        for name, value in sorted(gauges.items()):
+            lines.append("# TYPE svt_{} gauge".format(name))
+            lines.append("svt_{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+    def export(self, filename, fileformat, gauges):
+
+        snapshot = self.snapshot()
+        temporary = filename + ".tmp"
+        try:
+            with open(temporary, "w") as file:
+                if fileformat == "prometheus":
+                    file.write(self.prometheus(snapshot, gauges))
+                else:
+                    json.dump(dict(snapshot, gauges=gauges), file, separators=(",", ":"))
+            os.replace(temporary, filename)
+        except OSError as error:
+            _log.Error("Error writing {}: {}", filename, error)
+
+    def summary(self):
+
+        snapshot = self.snapshot()
+        heartbeat = snapshot["timings"].get("onHeartbeat", {"count": 0, "seconds": 0.})
+        calls = sum(api["count"] for api in snapshot["api"].values())
+        return "Heartbeat {:.1f} ms, API {:.0f} ms ({} calls, {} errors), {} switches".format(
+            1000 * heartbeat["seconds"] / max(1, heartbeat["count"]),
+            1000 * sum(api["seconds"] for api in snapshot["api"].values()) / max(1, calls), calls,
+            sum(api["errors"] for api in snapshot["api"].values()), sum(snapshot["switches"].values()))
+
+
+_metrics = Metrics()
+
+
+class Profiler:
+    """Profiles the plugin over a number of heartbeats (and the commands received meanwhile), on the plugin thread
+    and on the API worker thread, with cProfile for the statistics per function and a sampling thread for the
+    stacks, then writes '<filename>.pstats' and '<filename>.collapsed' (one 'caller;...;callee count' line per
+    stack, as used to draw flame graphs)"""
+
+    def __init__(self, filename, heartbeats=100, ondone=None, interval=0.001):
+        self.filename = filename
+        self.heartbeats = heartbeats  # number of heartbeats profiled
+        self.ondone = ondone  # called when the profile is written
+        self.interval = interval  # in seconds between two samples of the stack
+        self.active = False
+        self.profiles = {}  # {thread ident: cProfile.Profile}, as a profile only covers the thread enabling it
+        self.stacks = {}  # {collapsed stack: number of samples}
+        self.count = 0
+        self.depths = {}  # {thread ident: depth of the profiled calls running in the thread}
+        self.lock = threading.Lock()
+        self.sampler = None
+
+    def start(self):
+
+        if self.active:
+            return
+        self.active = True
+        with self.lock:
+            self.profiles = {}
+        self.stacks = {}
+        self.count = 0
+        self.sampler = threading.Thread(target=self.sample, name="SVT profiler", daemon=True)
+        self.sampler.start()
+        Domoticz.Status("Profiling the plugin for the next {} heartbeats".format(self.heartbeats))
+
+    def run(self, function, *args, **kwargs):
+        """runs function under the profiler, from the plugin thread or the API worker thread"""
+
+        thread = threading.get_ident()
+        with self.lock:
+            depth = self.depths.get(thread, 0)
+            self.depths[thread] = depth + 1
+            profile = self.profiles.setdefault(thread, cProfile.Profile()) if depth == 0 else None
+        if profile is not None:
+            with contextlib.suppress(ValueError):  # only one profile can be enabled at once since python 3.12
+                profile.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.depths[thread] -= 1
+                if self.depths[thread] == 0:
+                    del self.depths[thread]
+            if profile is not None:
+                profile.disable()
+                if function.__name__ == "onHeartbeat":
+                    self.count += 1
+                    if self.count >= self.heartbeats:
+                        self.stop()
+
+    def sample(self):
+
+        while self.active:
+            time.sleep(self.interval)
+            with self.lock:
+                threads = list(self.depths)
+            frames = sys._current_frames()
+            for thread in threads:
+                frame = frames.get(thread)
+                stack = []
+                while frame is not None:
+                    stack.append("{} ({}:{})".format(frame.f_code.co_name,
+                                                     os.path.basename(frame.f_code.co_filename),
+                                                     frame.f_code.co_firstlineno))
+                    frame = frame.f_back
+                if stack:
+                    collapsed = ";".join(reversed(stack))
+                    self.stacks[collapsed] = self.stacks.get(collapsed, 0) + 1
+
+    def stop(self):
+
+        if not self.active:
+            return
+        self.active = False
+        self.sampler.join(1)
+        # the statistics of the threads are merged (a profile still running in the worker is snapshotted)
+        stats = pstats.Stats()
+        with self.lock:
+            profiles = list(self.profiles.values())
+        for profile in profiles:
+            profile.create_stats()
+            if profile.stats:
+                stats.add(profile)
+        try:
+            stats.dump_stats(self.filename + ".pstats")
+            with open(self.filename + ".collapsed", "w") as file:
+                for stack, count in sorted(self.stacks.items()):
+                    file.write("{} {}\n".format(stack, count))
+            Domoticz.Status("Profile of {} heartbeats written to {}.pstats and {}.collapsed".format(
+                self.count, self.filename, self.filename))
+        except OSError as error:
+            _log.Error("Error writing the profile {}: {}", self.filename, error)
+        if self.ondone is not None:
+            self.ondone()
+
+
+class Scheduler:
+    """Due times of the timers of the plugin (the zones, the temperatures refresh, etc...) in a heap,
+    so that a heartbeat finds in no time that nothing is due"""
+
+    def __init__(self):
+        self.heap = []  # (due time, sequence, key), with outdated entries skipped when popped
+        self.timers = {}  # {key: due time}
+        self.sequence = itertools.count()
+        self.maxslippage = timedelta(0)
+
+    def schedule(self, key, due):
+
+        if due is None:
+            self.timers.pop(key, None)
+        elif self.timers.get(key) != due:
+            self.timers[key] = due
+            heapq.heappush(self.heap, (due, next(self.sequence), key))
+
+    def due(self, now, tolerance):
+        """returns the set of the keys of the timers due at 'now', and unschedules them"""
+
+        keys = set()
+        while self.heap and self.heap[0][0] <= now:
+            due, _, key = heapq.heappop(self.heap)
+            if self.timers.get(key) != due:
+                continue
+            del self.timers[key]
+            keys.add(key)
+            slippage = now - due
+            if slippage > tolerance:
+                _log.Debug("Timer '{}' ran {} late", key, slippage)
+                self.maxslippage = max(self.maxslippage, slippage)
+        return keys
+
+    def next(self):
+
+        while self.heap and self.timers.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+
+class SensorHealth:
+    """Keeps the state of the temperature sensors: last value and update time, whether they are timed out,
+    and the time at which they will be. The expiry times are kept in a heap so that checking for the sensors
+    that timed out costs nothing until one actually does"""
+
+    def __init__(self, timeout, aggregation="mean", spike=0):
+        self.timeout = timedelta(minutes=timeout)
+        self.aggregation = aggregation  # "mean", "median" or "trimmed" (mean without the lowest and highest)
+        self.spike = spike  # jump in °C between two readings held back until confirmed (0 to accept all)
+        self.sensors = {}  # {idx: {"Name", "Temp", "LastUpdate" (raw string), "Time", "Expiry", "Active", "Held"}}
+        self.expiries = []  # heap of (expiry time, idx)
+
+    @staticmethod
+    def parseTime(datestring):
+
+        dateformat = "%Y-%m-%d %H:%M:%S"
+        # the below try/except is meant to address an intermittent python bug in some embedded systems
+        try:
+            return datetime.strptime(datestring, dateformat)
+        except TypeError:
+            return datetime(*(time.strptime(datestring, dateformat)[0:6]))
+
+    def update(self, devices, now):
+        """updates the state of the sensors from a dict of devices as returned by the getdevices API"""
+
+        for idx, device in devices.items():
+            if "Temp" not in device:
+                continue
+            sensor = self.sensors.get(idx)
+            if sensor is None:
+                sensor = self.sensors[idx] = {"Name": device["Name"], "Temp": None, "LastUpdate": None,
+                                              "Time": None, "Expiry": None, "Active": True, "Held": None}
+            if device["LastUpdate"] == sensor["LastUpdate"]:
+                continue  # no new reading, the timestamp is already parsed
+            sensor["LastUpdate"] = device["LastUpdate"]
+            sensor["Time"] = self.parseTime(device["LastUpdate"])
+            sensor["Expiry"] = sensor["Time"] + self.timeout
+            _log.Debug("device: {}-{} = {}", idx, sensor["Name"], device["Temp"])
+            self.accept(idx, sensor, device["Temp"])
+            if sensor["Expiry"] > now:
+                self.push(sensor["Expiry"], idx)
+                if not sensor["Active"]:
+                    Domoticz.Status("previously timed out temperature sensor '{}' is back online".format(
+                        sensor["Name"]))
+                    sensor["Active"] = True
+            else:
+                self.timedOut(sensor)
+
+    def snapshot(self):
+
+        return {str(idx): {"Name": sensor["Name"], "Temp": sensor["Temp"], "LastUpdate": sensor["LastUpdate"],
+                           "Active": sensor["Active"]} for idx, sensor in self.sensors.items()}
+
+    def restore(self, sensors, now):
+
+        for idx, saved in sensors.items():
+            try:
+                sensor = {"Name": saved["Name"], "Temp": saved["Temp"], "LastUpdate": saved["LastUpdate"],
+                          "Time": self.parseTime(saved["LastUpdate"]), "Active": bool(saved["Active"]), "Held": None}
+            except (KeyError, ValueError, TypeError):
+                continue
+            sensor["Expiry"] = sensor["Time"] + self.timeout
+            self.sensors[int(idx)] = sensor
+            if sensor["Expiry"] > now:
+                self.push(sensor["Expiry"], int(idx))
+            else:
+                sensor["Active"] = False
+
+    def push(self, expiry, idx):
+
+        heapq.heappush(self.expiries, (expiry, idx))
+        # the expiries superseded by a newer reading are dropped once they outnumber the live ones
+        if len(self.expiries) > 2 * len(self.sensors) + 8:
+            self.expiries = [(expiry, idx) for expiry, idx in self.expiries if self.sensors[idx]["Expiry"] == expiry]
+            heapq.heapify(self.expiries)
+
+    def next(self):
+        """returns the time at which the next sensor will time out, or None"""
+
+        while self.expiries and self.sensors[self.expiries[0][1]]["Expiry"] != self.expiries[0][0]:
+            heapq.heappop(self.expiries)
+        return self.expiries[0][0] if self.expiries else None
+
+    def accept(self, idx, sensor, temp):
+
+        # a reading too far from the previous one is held back until the next reading confirms it
+        if self.spike and sensor["Temp"] is not None and abs(temp - sensor["Temp"]) > self.spike and \
+                (sensor["Held"] is None or abs(temp - sensor["Held"]) > self.spike):
+            _log.Debug("holding back spike of sensor {}: {} after {}", idx, temp, sensor["Temp"])
+            sensor["Held"] = temp
+        else:
+            sensor["Temp"] = temp
+            sensor["Held"] = None
+
+    def timedOut(self, sensor):
+
+        if sensor["Active"]:
+            _log.Error("skipping timed out temperature sensor '{}'", sensor["Name"])
+            sensor["Active"] = False
+
+    def expire(self, now):
+
+        while self.expiries and self.expiries[0][0] <= now:
+            expiry, idx = heapq.heappop(self.expiries)
+            sensor = self.sensors[idx]
+            if sensor["Expiry"] == expiry:  # else the sensor was updated since
+                self.timedOut(sensor)
+
+    def aggregate(self, idxs):
+        """returns the aggregated temperature of the active sensors among idxs, or None if there is none"""
+
+        temps = sorted(self.sensors[idx]["Temp"] for idx in idxs
+                       if idx in self.sensors and self.sensors[idx]["Active"] and self.sensors[idx]["Temp"] is not None)
+        if not temps:
+            return None
+        if self.aggregation == "median":
+            middle = len(temps) // 2
+            return temps[middle] if len(temps) % 2 else (temps[middle - 1] + temps[middle]) / 2
+        if self.aggregation == "trimmed" and len(temps) > 2:
+            temps = temps[1:-1]
+        return sum(temps) / len(temps)
+
+
+def fitConstants(cycles, ConstC, mincycles=20, minspread=0.25):
+    """least squares fit of ConstC and ConstT over a list of cycles (power, inside temp, outside temp or nan,
+    inside temp at the end of the cycle, cycle duration as a fraction of the calculation period), for the model
+    power * duration = ConstC * (end temp - inside temp) + ConstT * (end temp - outside temp) * duration
+    which is the model the thermostat uses to calculate the power. Cycles with outlier residuals are rejected, and
+    so are the cycles without outside temp unless too few have one, in which case ConstC is fitted alone.
+    ConstC is only refitted if the inside temperature changes of the cycles spread over more than 'minspread'
+    (otherwise the sensors' noise would bias it towards zero), else the current ConstC is kept.
+    Returns (ConstC, ConstT or None if no outside temp, number of cycles used) or None if the fit is not valid"""
+
+    if len(cycles) < mincycles:
+        return None
+    data = numpy.array(cycles, dtype=float)
+    valid = numpy.isfinite(data[:, 2])
+    hasouttemp = valid.sum() >= mincycles
+    if hasouttemp:
+        data = data[valid]
+    power, intemp, outtemp, endtemp, duration = data.T
+    rise = endtemp - intemp
+    loss = (endtemp - outtemp) * duration
+    y = power * duration
+    if rise.std() >= minspread:
+        x = numpy.column_stack((rise, loss)) if hasouttemp else rise[:, None]
+    elif hasouttemp:
+        x = loss[:, None]  # fit ConstT only
+        y = y - ConstC * rise
+    else:
+        return None
+    keep = numpy.ones(len(y), dtype=bool)
+    for iteration in range(3):
+        if keep.sum() < mincycles:
+            return None
+        coeffs, residuals, rank, singular = numpy.linalg.lstsq(x[keep], y[keep], rcond=None)
+        if rank < x.shape[1]:
+            return None
+        errors = y - x @ coeffs
+        deviation = max(1.4826 * numpy.median(numpy.abs(errors[keep] - numpy.median(errors[keep]))), 1.)
+        inliers = numpy.abs(errors) <= 3 * deviation
+        if (inliers == keep).all():
+            break
+        keep = inliers
+    if not numpy.isfinite(coeffs).all() or (coeffs < 0).any():
+        return None
+    if x.shape[1] == 1 and hasouttemp:
+        return ConstC, float(coeffs[0]), int(keep.sum())
+    if coeffs[0] == 0:
+        return None
+    return float(coeffs[0]), float(coeffs[1]) if hasouttemp else None, int(keep.sum())
+
+
+def timeToStr(value):
+
+    return None if value is None else value.isoformat()
+
+
+def strToTime(value):
+
+    return None if value is None else datetime.fromisoformat(value)
+
+
+def parseZones(strCSV):
+    """parses a csv list of idx per zone, zones being separated by ';'"""
+
+    return [[int(val) for val in parseCSV(group)] for group in strCSV.split(";")]
+
+
+class DeviceStream:
+    """Incremental decoder of the json response of the getdevices API: the "result" array is decoded one device
+    at a time as the response is received, and only the wanted devices and the fields used by the plugin are
+    kept, so that a large installation does not have to be held in memory as a whole"""
+
+    FIELDS = ("idx", "Name", "Temp", "Status", "LastUpdate")
+    ALL = "all"  # as 'wanted', to keep all the devices
+    WHITESPACE = re.compile(r"[ \t\n\r]*")
+    DELIMITERS = ",:]} \t\n\r"  # the characters that can follow a json value
+
+    def __init__(self, wanted, chunksize=65536):
+        self.wanted = None if wanted == self.ALL else set(wanted)
+        self.chunksize = chunksize
+        self.decoder = json.JSONDecoder()
+        self.nbytes = 0  # bytes of the response read
+        self.count = 0  # devices in the response
+        self.response = None
+        self.utf8 = None
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def read(self, response):
+        """reads and decodes the whole response, returns the json object with the filtered "result" array"""
+
+        self.response = response
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.nbytes = self.count = 0
+        resultJson = {}
+        self.expect("{")
+        while not self.peek("}"):
+            if resultJson:
+                self.expect(",")
+            key = self.value()
+            self.expect(":")
+            resultJson[key] = self.devices() if key == "result" and self.peek("[") else self.value()
+        self.pos += 1
+        while self.more():  # drain the response so that the connection can be reused
+            pass
+        return resultJson
+
+    def more(self):
+
+        if self.eof:
+            return False
+        chunk = self.response.read(self.chunksize)
+        if not chunk:
+            self.eof = True
+            return False
+        self.nbytes += len(chunk)
+        self.buffer = self.buffer[self.pos:] + self.utf8.decode(chunk)
+        self.pos = 0
+        return True
+
+    def peek(self, char):
+
+        while True:
+            self.pos = self.WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos] == char
+            if not self.more():
+                raise ValueError("truncated json response")
+
+    def expect(self, char):
+
+        if not self.peek(char):
+            raise ValueError("expected '{}' at '{}'".format(char, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def value(self):
+
+        self.peek("")
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.more():
+                    raise
+                continue
+            # a number could go on in the next chunk (e.g. "1." of "1.5e3"): it ends with a delimiter or the response
+            if (end < len(self.buffer) and self.buffer[end] in self.DELIMITERS) or not self.more():
+                self.pos = end
+                return value
+
+    def devices(self):
+
+        devices = []
+        self.pos += 1
+        if self.peek("]"):
+            self.pos += 1
+            return devices
+        while True:
+            device = self.value()
+            self.count += 1
+            if isinstance(device, dict) and (self.wanted is None or int(device.get("idx", 0)) in self.wanted):
+                devices.append({field: device[field] for field in self.FIELDS if field in device})
+            if self.peek("]"):
+                self.pos += 1
+                return devices
+            self.expect(",")
+
+
+class APIConnection:
+    """Pool of keep-alive http connections to the Domoticz json API.
+    After 'threshold' consecutive failures to reach the web server, a circuit breaker stops the calls for
+    'backoff' seconds (doubled after each failed trial call, up to 'maxbackoff'), and the read calls are
+    meanwhile answered from the last good response if it is less than 'cachettl' seconds old"""
+
+    def __init__(self, maxidle=4, timeout=10, threshold=3, backoff=10, maxbackoff=300, cachettl=600):
+        self.host = "localhost"
+        self.port = 8080
+        self.headers = {}
+        self.maxidle = maxidle  # max number of idle connections kept open for reuse
+        self.timeout = timeout  # in seconds, so that a stalled web server cannot block the API calls forever
+        self.idle = []
+        self.lock = threading.Lock()
+        self.lastlatency = 0.
+        self.targeted = None  # whether the API supports targeted device queries (None = not yet known)
+        self.targetedshare = 0.05  # largest share of the devices of a listing read by targeted queries
+        self.listings = {}  # {APICall: number of devices in its last streamed response} of the device scans
+        self.snapshot = None  # DeviceSnapshot shared with the other SVT hardware, used instead of the device queries
+        self.threshold = threshold
+        self.minbackoff = backoff
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.failures = 0  # consecutive failures to reach the web server
+        self.openuntil = datetime.min  # clock() until which the calls are stopped once the breaker is open
+        self.trial = False  # a trial call is in progress while the breaker is open
+        self.cachettl = cachettl
+        self.cache = {}  # {APICall: (clock() of the response, response)} of the read calls
+
+    def configure(self, timeout, threshold, backoff, maxbackoff, cachettl):
+
+        self.timeout = timeout
+        self.threshold = threshold
+        self.minbackoff = self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.cachettl = cachettl
+
+    def setup(self, address, port, username="", password=""):
+
+        self.close()
+        self.host = address
+        self.port = int(port)
+        self.headers = {"Connection": "keep-alive"}
+        if username != "":
+            _log.Debug("Add authentification for user {}", username)
+            credentials = ('%s:%s' % (username, password))
             encoded_credentials = base64.b64encode(credentials.encode('ascii'))
-            req.add_header('Authorization', 'Basic %s' % encoded_credentials.decode("ascii"))
-
-        response = request.urlopen(req)
-        if response.status == 200:
-            resultJson = json.loads(response.read().decode('utf-8'))
-            if resultJson["status"] != "OK":
-                Domoticz.Error("Domoticz API returned an error: status = {}".format(resultJson["status"]))
-                resultJson = None
+            self.headers["Authorization"] = 'Basic %s' % encoded_credentials.decode("ascii")
+
+    def acquire(self):
+
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def release(self, connection):
+
+        with self.lock:
+            if len(self.idle) < self.maxidle:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+    def fetch(self, path, stream=None):
+
+        while True:
+            connection = self.acquire()
+            reused = connection.sock is not None
+            try:
+                connection.request("GET", path, headers=self.headers)
+                response = connection.getresponse()
+                data = stream.read(response) if stream is not None and response.status == 200 else response.read()
+            except (http.client.HTTPException, OSError) as error:
+                connection.close()
+                if reused and not isinstance(error, (socket.timeout, TimeoutError)):
+                    # the server dropped our idle keep-alive connection, reconnect transparently
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(connection)
+            return response.status, data
+
+    def call(self, APICall, wanted=None):
+        """makes the API call and returns its json response, or None if it failed. With a list of 'wanted' idx,
+        the "result" array of the response is decoded as it is received and only these devices are kept
+        (or all the devices with DeviceStream.ALL), with the fields used by the plugin"""
+
+        return self.request(APICall, wanted)[0]
+
+    def request(self, APICall, wanted=None):
+        """same as call, but returns (json response or None, whether the call may succeed if retried): False when
+        Domoticz answered with an error, or when the calls are paused because the web server is not responding"""
+
+        read = "param=get" in APICall  # only the responses of the read calls are cached
+        key = APICall if wanted is None else (APICall, wanted if wanted == DeviceStream.ALL else frozenset(wanted))
+        if not self.allow():
+            _log.Debug("Domoticz API call skipped while the web server is not responding: {}", APICall)
+            return self.cached(key) if read else None, False
+        resultJson = None
+        nbytes = 0
+        stream = DeviceStream(wanted) if wanted is not None else None
+        failed = True  # the web server could not be reached or failed
+        path = "/json.htm?{}".format(parse.quote(APICall, safe="&="))
+        _log.Debug("Calling domoticz API: {}", path)
+        start = time.monotonic()
+        try:
+            status, data = self.fetch(path, stream)
+            failed = status >= 500
+            if status == 200 and stream is not None:
+                nbytes = stream.nbytes
+                resultJson = data
+                with self.lock:
+                    self.listings[APICall] = stream.count
+                _log.Debug("Kept {} of the {} devices of the response", len(data.get("result", [])), stream.count)
+            else:
+                nbytes = len(data)
+            if status == 200:
+                if stream is None:
+                    resultJson = json.loads(data.decode('utf-8'))
+                if resultJson["status"] != "OK":
+                    _log.Error("Domoticz API returned an error: status = {}", resultJson["status"])
+                    resultJson = None
+            else:
+                _log.Error("Domoticz API: http error = {}", status)
+        except (http.client.HTTPException, OSError) as error:
+            _log.Debug("Error calling 'http://{}:{}{}': {}", self.host, self.port, path, error)
+        except (ValueError, KeyError, TypeError) as error:
+            _log.Error("Invalid response to 'http://{}:{}{}': {}", self.host, self.port, path, error)
+        self.lastlatency = time.monotonic() - start
+        _log.Debug("Domoticz API call completed in {:.0f} ms", self.lastlatency * 1000)
+        _metrics.apiCall(APICall, self.lastlatency, nbytes, resultJson is None)
+        self.record(failed)
+        if resultJson is not None:
+            if read:
+                with self.lock:
+                    self.cache[key] = (clock(), resultJson)
+            return resultJson, False
+        return self.cached(key) if read and failed else None, failed
+
+    def allow(self):
+
+        with self.lock:
+            if self.failures < self.threshold:
+                return True  # breaker closed
+            if clock() < self.openuntil or self.trial:
+                return False  # breaker open
+            self.trial = True  # one trial call to check if the web server is back
+            return True
+
+    def record(self, failed):
+
+        recovered = opened = False
+        with self.lock:
+            if not failed:
+                recovered = self.failures >= self.threshold
+                self.failures = 0
+                self.trial = False
+                self.backoff = self.minbackoff
+            else:
+                self.failures += 1
+                if self.trial:
+                    self.trial = False
+                    self.backoff = min(self.backoff * 2, self.maxbackoff)
+                    self.openuntil = clock() + timedelta(seconds=self.backoff)
+                elif self.failures == self.threshold:
+                    self.openuntil = clock() + timedelta(seconds=self.backoff)
+                    opened = True
+        if recovered:
+            Domoticz.Status("Domoticz API is responding again: resuming the API calls")
+        elif opened:
+            _log.Error("Domoticz API at {}:{} is not responding: pausing the API calls for {} seconds",
+                       self.host, self.port, self.backoff)
+        elif failed and self.failures > self.threshold:
+            _log.Debug("Domoticz API still not responding: next trial in {} seconds", self.backoff)
+
+    def cached(self, key):
+
+        with self.lock:
+            entry = self.cache.get(key)
+        if entry is not None:
+            age = timedelta.total_seconds(clock() - entry[0])
+            if age <= self.cachettl:
+                _log.Debug("Using the response to {} from {:.0f} seconds ago", key, age)
+                return entry[1]
+        return None
+
+    def responding(self):
+        """whether the last call reached the web server, else the responses are missing or stale"""
+
+        with self.lock:
+            return self.failures == 0
+
+
+_api = APIConnection()
+
+
+class APIWorker(threading.Thread):
+    """Thread making the (blocking) Domoticz API calls on behalf of the plugin thread.
+    Jobs are run in order of submission, and their completion callbacks are run back on the
+    plugin thread when processResults() is called from the heartbeat"""
+
+    def __init__(self):
+        super().__init__(name="SVT API worker", daemon=True)
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.outstanding = 0  # jobs with a callback not run yet (only used from the plugin thread)
+        self.profiler = None  # Profiler of the plugin, the jobs are profiled too while it is active
+
+    def submit(self, job, callback=None):
+
+        if callback is not None:
+            self.outstanding += 1
+        self.requests.put((job, callback))
+
+    def pending(self):
+
+        return self.outstanding > 0
+
+    def run(self):
+
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            job, callback = item
+            try:
+                profiler = self.profiler
+                result = profiler.run(job) if profiler is not None and profiler.active else job()
+            except Exception as error:
+                _log.Error("Error in API worker: {}", error)
+                result = None
+            if callback is not None:
+                self.results.put((callback, result))
+
+    def processResults(self):
+        """runs the callbacks of the completed jobs, returns how many were run"""
+
+        count = 0
+        while True:
+            try:
+                callback, result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.outstanding -= 1
+            count += 1
+            callback(result)
+        return count
+
+    def stop(self, timeout=15):
+
+        self.requests.put(None)
+        self.join(timeout)
+        if self.is_alive():
+            _log.Error("API worker did not stop within {} seconds", timeout)
+
+
+def DomoticzAPI(APICall, wanted=None):
+
+    return _api.call(APICall, wanted)
+
+
+class HeaterActuator:
+    """Sets the heater switches, keeping track of their last known state so that no API call is made
+    when the heaters are already known to be in the desired state. A known state is trusted for 'ttl'
+    minutes, after which (or after a failed command) it is verified again against Domoticz.
+    Commands are sent concurrently with retries, and a Domoticz group (or scene) switches all the heaters
+    of a zone in one call when they all need to change"""
+
+    def __init__(self, ttl, groups=None, threads=4, retries=2, retrydelay=0.5):
+        self.ttl = timedelta(minutes=ttl)
+        self.states = {}  # {idx: (is on, time when the state was last confirmed)}
+        self.lock = threading.Lock()  # states is changed by the worker thread and saved by the plugin thread
+        self.groups = groups or {}  # {group idx: [heaters idx]}
+        self.threads = threads
+        self.retries = retries
+        self.retrydelay = retrydelay  # in seconds, doubled at each retry
+        self.pool = None
+
+    def reconcile(self, heaters):
+
+        # refresh the known states of the heater switches from Domoticz
+        now = clock()
+        devices = DomoticzDevices(heaters, "light")
+        with self.lock:
+            for idx in heaters:
+                self.states.pop(idx, None)
+            for idx, device in devices.items():  # parse the switch devices
+                if "Status" in device:
+                    self.states[idx] = (device["Status"] == "On", now)
+                    _log.Debug("Heater switch {} currently is '{}'", idx, device["Status"])
+                else:
+                    _log.Error("Device with idx={} does not seem to be a switch !", idx)
+            known = any(idx in self.states for idx in heaters)
+
+        # fool proof checking.... based on users feedback (unless Domoticz could not be asked)
+        if not known and _api.responding():
+            _log.Error("none of the devices in the 'heaters' parameter is a switch... no action !")
+
+    def snapshot(self):
+
+        with self.lock:
+            states = dict(self.states)
+        return {str(idx): [on, timeToStr(confirmed)] for idx, (on, confirmed) in states.items()}
+
+    def restore(self, states):
+
+        for idx, saved in states.items():
+            try:
+                state = (bool(saved[0]), strToTime(saved[1]))
+            except (ValueError, TypeError, IndexError):
+                continue
+            with self.lock:
+                self.states[int(idx)] = state
+
+    def stale(self, heaters, now):
+
+        with self.lock:
+            return [idx for idx in heaters if idx not in self.states or now - self.states[idx][1] >= self.ttl]
+
+    def command(self, APICall):
+
+        # sends a command, retrying with an increasing delay if the web server could not be reached
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retrydelay * 2 ** (attempt - 1))
+            response, retry = _api.request(APICall)
+            if response:
+                return True
+            if not retry:
+                return False  # Domoticz rejected the command, it would be rejected again
+        return False
+
+    @timed("switchHeat")
+    def switch(self, desired):
+        """desired is a dict {idx: True/False} of the requested heater states.
+        Returns the dict of the heaters actually switched and the list of the heaters that failed to switch"""
+
+        stale = self.stale(desired, clock())
+        if stale:
+            self.reconcile(stale)
+
+        # flip on / off as needed
+        with self.lock:
+            changes = {idx: switch for idx, switch in desired.items()
+                       if idx in self.states and self.states[idx][0] != switch}
+        if not changes:
+            _log.Debug("Heaters already in the requested state... no action")
+        changed = {}
+        failed = []
+
+        # switch whole groups in one call
+        for group, heaters in self.groups.items():
+            switches = {changes.get(idx) for idx in heaters}
+            if len(switches) == 1 and None not in switches:
+                switch = switches.pop()
+                if self.command("type=command&param=switchscene&idx={}&switchcmd={}".format(
+                        group, "On" if switch else "Off")):
+                    for idx in heaters:
+                        changes.pop(idx, None)  # a heater may belong to several groups
+                        changed[idx] = switch
+
+        # then the remaining heaters, concurrently
+        APICalls = {idx: "type=command&param=switchlight&idx={}&switchcmd={}".format(idx, "On" if switch else "Off")
+                    for idx, switch in changes.items()}
+        if len(APICalls) > 1 and self.threads > 1:
+            if self.pool is None:
+                self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads,
+                                                                  thread_name_prefix="SVT switch")
+            futures = {idx: self.pool.submit(self.command, APICall) for idx, APICall in APICalls.items()}
+            results = {idx: future.result() for idx, future in futures.items()}
         else:
-            Domoticz.Error("Domoticz API: http error = {}".format(response.status))
-    except:
-        Domoticz.Error("Error calling '{}'".format(url))
-    return resultJson
+            results = {idx: self.command(APICall) for idx, APICall in APICalls.items()}
+        for idx, success in results.items():
+            if success:
+                changed[idx] = changes[idx]
+            else:
+                failed.append(idx)
+
+        now = clock()
+        with self.lock:
+            for idx, switch in changed.items():
+                self.states[idx] = (switch, now)
+            for idx in failed:
+                self.states.pop(idx, None)  # unknown state, to be verified at next switching
+        if changed and _api.snapshot is not None:
+            _api.snapshot.touch("light")  # the shared snapshot no longer has the state of our heaters
+        return changed, failed
+
+    def shutdown(self):
+
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+
+class DeviceSnapshot:
+    """Listings of the temperature and light devices shared by all the SVT hardware through files of the plugin
+    folder ('<prefix>_<device filter>.json', in the format of the getdevices API with the time of the listing).
+    A listing older than 'ttl' seconds is refreshed by one instance at a time, under a file lock, and the other
+    instances then read it from the file instead of calling the API, decoding it incrementally to keep only the
+    requested devices"""
+
+    def __init__(self, prefix, ttl):
+        self.prefix = prefix
+        self.ttl = timedelta(seconds=ttl)
+        self.cache = {}  # {devicefilter: (mtime of the file read, idx wanted, time of the listing, {idx: device})}
+        self.touched = {}  # {devicefilter: clock() when this instance last changed such a device}
+
+    def devices(self, idxs, devicefilter):
+        """returns a dict {idx: device} of the requested devices, or None if there is no fresh listing"""
+
+        filename = "{}_{}.json".format(self.prefix, devicefilter)
+        wanted = frozenset(idxs)
+        try:
+            devices = self.read(filename, devicefilter, wanted)
+            if devices is None:
+                with open(filename + ".lock", "w") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)  # released when the file is closed
+                    # another instance may have refreshed it while we waited
+                    devices = self.read(filename, devicefilter, wanted)
+                    if devices is None and self.refresh(filename, devicefilter):
+                        devices = self.read(filename, devicefilter, wanted)
+        except OSError as error:
+            _log.Error("Error using the shared device snapshot {}: {}", filename, error)
+            return None
+        if devices is None:
+            return None
+        return {idx: devices[idx] for idx in wanted if idx in devices}
+
+    def touch(self, devicefilter):
+
+        self.touched[devicefilter] = clock()
+
+    def read(self, filename, devicefilter, wanted):
+        """returns the devices of the listing of the file, with at least the wanted ones, or None if not fresh"""
+
+        try:
+            file = open(filename, "rb")
+        except FileNotFoundError:
+            return None
+        with file:
+            mtime = os.fstat(file.fileno()).st_mtime_ns
+            cached = self.cache.get(devicefilter)
+            if cached is None or cached[0] != mtime or not wanted <= cached[1]:
+                try:
+                    listing = DeviceStream(wanted).read(file)
+                    listed = strToTime(listing["time"])
+                    devices = {int(device["idx"]): device for device in listing.get("result", [])}
+                except (ValueError, KeyError, TypeError) as error:
+                    _log.Debug("Invalid shared device snapshot {}: {}", filename, error)
+                    return None
+                cached = self.cache[devicefilter] = (mtime, wanted, listed, devices)
+        listed, devices = cached[2], cached[3]
+        now = clock()
+        touched = self.touched.get(devicefilter)
+        if not now - self.ttl < listed <= now or (touched is not None and listed <= touched):
+            return None
+        return devices
+
+    def refresh(self, filename, devicefilter):
+
+        listed = clock()
+        devicesAPI = DomoticzAPI("type=command&param=getdevices&filter={}&used=true&order=Name".format(devicefilter),
+                                 DeviceStream.ALL)
+        if not devicesAPI:
+            return False
+        temporary = "{}.{}.tmp".format(filename, os.getpid())
+        with open(temporary, "w") as file:
+            json.dump({"time": timeToStr(listed), "result": devicesAPI.get("result", [])}, file,
+                      separators=(",", ":"))
+        os.replace(temporary, filename)
+        _log.Debug("Shared snapshot of the {} devices refreshed ({} devices)", devicefilter,
+                   len(devicesAPI.get("result", [])))
+        return True
+
+
+def DomoticzDevices(idxs, devicefilter):
+    """returns a dict {idx: device} with the json description of the requested devices"""
+
+    if _api.snapshot is not None:
+        devices = _api.snapshot.devices(idxs, devicefilter)
+        if devices is not None:
+            return devices
+
+    wanted = set(idxs)
+    devices = {}
+    scan = "type=command&param=getdevices&filter={}&used=true&order=Name".format(devicefilter)
+    # a targeted query costs about as much as scanning 20 devices: they are only used for a small share of the
+    # devices, known from a first scan
+    listed = _api.listings.get(scan)
+    if _api.targeted is not False and listed is not None and len(wanted) <= _api.targetedshare * listed:
+        # query only the devices we need, one idx at a time over the keep-alive connection
+        for idx in wanted:
+            devicesAPI = DomoticzAPI("type=command&param=getdevices&rid={}".format(idx))
+            if devicesAPI is None:
+                continue
+            result = devicesAPI.get("result", [])
+            if len(result) > 1 or any(int(device["idx"]) != idx for device in result):
+                Domoticz.Status("Domoticz API ignores targeted device queries: reverting to full device scans")
+                _api.targeted = False
+                devices = {}
+                break
+            if result:
+                _api.targeted = True
+                devices[idx] = result[0]
+        else:
+            return devices
+
+    # else fetch all the devices of this type and scan for the ones we need
+    # the devices we do not need are dropped as the response is decoded
+    devicesAPI = DomoticzAPI(scan, wanted)
+    if devicesAPI:
+        for device in devicesAPI.get("result", []):
+            idx = int(device["idx"])
+            if idx in wanted:
+                devices[idx] = device
+    return devices
+
+
+# advanced settings, that can be overridden in the optional "svt_config.json" file of the plugin folder
+ConfigDefaults = {
+    "HeaterStateTTL": 15,  # time in minutes a known heater switch state is trusted before being verified again
+    "Calibration": "incremental",  # "batch" to refit ConstC and ConstT over a window of cycles (requires numpy)
+    "CalibrationWindow": 200,  # number of cycles kept for the batch calibration
+    "CalibrationMinCycles": 20,  # minimum number of valid cycles for a batch calibration
+    "InternalsFlushInterval": 15,  # minimum time in minutes between two writes of the learned internals to disk
+    "MirrorUserVariable": False,  # also keep the learned internals in the "<plugin name>-InternalVariables" user variable
+    "MQTTAddress": "",  # address of the MQTT broker where Domoticz pushes its updates ("" to only poll the API)
+    "MQTTPort": 1883,
+    "MQTTTopic": "domoticz/out",
+    "PushThreshold": 0.5,  # pushed temperature gap in °C below the setpoint that starts heating ahead of schedule
+    "PushTimeout": 15,  # time in minutes without any pushed message after which the temperatures are polled again
+    "SwitchThreads": 4,  # maximum number of heater switch commands sent concurrently
+    "SwitchRetries": 2,  # number of retries of a failed heater switch command
+    "SwitchRetryDelay": 0.5,  # delay in seconds before the first retry, doubled at each retry
+    "HeaterGroups": {},  # {"<zone number>": <idx of a Domoticz group or scene switching all the heaters of the zone>}
+    "TempAggregation": "mean",  # "median" or "trimmed" (mean without lowest and highest) of the sensors of a zone
+    "SpikeThreshold": 0.0,  # jump in °C between two readings of a sensor ignored unless confirmed (0 to disable)
+    "HeartbeatIdle": 30,  # heartbeat interval in seconds when no timer is due soon (30 maximum)
+    "HeartbeatFine": 5,  # shortest heartbeat interval in seconds, used while waiting for the API
+    "MetricsFormat": "",  # "prometheus" or "json" to write the metrics to svt_metrics_<hardware id>.prom/.json
+    "MetricsInterval": 5,  # time in minutes between two exports of the metrics
+    "MetricsDevice": False,  # show a summary of the metrics in a text device
+    "ProfilingDevice": False,  # add a switch that profiles the plugin for ProfileHeartbeats heartbeats
+    "ProfileHeartbeats": 100,
+    "ProfileAtStart": False,  # profile the first ProfileHeartbeats heartbeats
+    "LogBufferSize": 200,  # number of recent debug messages logged with an error when debug is off (0 to disable)
+    "APITimeout": 10,  # time in seconds after which an API call is abandoned
+    "BreakerThreshold": 3,  # consecutive failed API calls after which the calls are paused
+    "BreakerBackoff": 10,  # first pause in seconds of the API calls, doubled while the web server does not respond
+    "BreakerMaxBackoff": 300,  # longest pause in seconds of the API calls
+    "APICacheTTL": 10,  # time in minutes a device or user variable read is reused while the API does not respond
+    "TargetedShare": 0.05,  # largest share of the devices of a type read with one query each rather than a scan
+    "History": False,  # publish the history of the thermostats for the SVT viewer in www/templates/svt_history.json
+    "HistoryStep": 5,  # time in minutes over which the history samples are merged
+    "HistoryDays": 1,  # number of days of history kept
+    "HistoryInterval": 5,  # minimum time in minutes between two writes of the history file
+    "SharedSnapshot": False,  # share the device listings with the other SVT hardware through svt_devices_*.json
+    "SharedSnapshotTTL": 60,  # time in seconds a shared device listing is used before being refreshed
+    "AdaptivePeriod": False,  # adapt the calculation period between PeriodMin and PeriodMax to the control error
+    "PeriodMin": 10,  # shortest calculation period in minutes, used when the error reaches AdaptiveError
+    "PeriodMax": 60,  # longest calculation period in minutes, used when the zone is stable at its setpoint
+    "AdaptiveError": 0.5,  # temperature in °C below the setpoint, now or expected, giving the shortest period
+    "CycleArchive": True,  # keep the history of the calculation cycles in svt_cycles_<hardware id>.bin
+    "CycleBuffer": 500,  # number of recent cycles kept in memory
+    "CycleArchiveDays": 30,  # days of detailed cycles, the older ones being downsampled to one record per day
+    "Boost": True,  # heat at full power while the inside temperature is more than BoostGap below the setpoint
+    "BoostGap": 0.5}  # in °C
+
+
+def loadConfig():
+    """reads the optional advanced settings file, of the form {"default": {...}, "<hardware name>": {...}}
+    where the settings of the section named as the plugin's hardware override the "default" section"""
+
+    config = ConfigDefaults.copy()
+    filename = os.path.join(Parameters["HomeFolder"], "svt_config.json")
+    if not os.path.isfile(filename):
+        return config
+    try:
+        with open(filename) as file:
+            sections = json.load(file)
+        for section in ("default", Parameters["Name"]):
+            for name, value in sections.get(section, {}).items():
+                if name in config:
+                    config[name] = CheckParam(name, value, ConfigDefaults[name])
+                else:
+                    _log.Error("Unknown setting '{}' in {}", name, filename)
+    except (OSError, ValueError, AttributeError) as error:
+        _log.Error("Error reading {}: {}", filename, error)
+    return config
 
 
 def CheckParam(name, value, default):
-    if type(default) is int and type(value) is int:
-        param = value
-    elif type(default) is float and type(value) is float:
+    if type(default) is type(value):
         param = value
+    elif type(default) is float and type(value) is int:  # e.g. 1 for 1.0 in the json config file
+        param = float(value)
     else:
         param = default
-        Domoticz.Error("Parameter '{}' has an invalid value of '{}' ! defaut of '{}' is instead used.".format(name, value, default))
+        _log.Error("Parameter '{}' has an invalid value of '{}' ! defaut of '{}' is instead used.", name, value, default)
     return param
 
 
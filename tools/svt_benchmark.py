@@ -0,0 +1,303 @@
+"""
+Smart Virtual Thermostat benchmark
+Measures the cost of the plugin's control loop against a local fake Domoticz json API serving synthetic
+getdevices payloads of 10 to 10,000 devices: time, memory allocations and bytes parsed per heartbeat, for
+several numbers of sensors and heaters, with the targeted device queries of the API or full device scans.
+The results are compared to a baseline file so that regressions are visible.
+
+Usage: python tools/svt_benchmark.py [--sizes 10,100,1000,10000] [--cycles 10] [--save-baseline] [--check]
+"""
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import importlib
+import statistics
+import tracemalloc
+import http.client
+import multiprocessing
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+
+from svt_simulator import PLUGIN_FOLDER, SimClock, FakeDomoticz, SyncWorker
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "svt_benchmark_baseline.json")
+
+LAYOUTS = ((1, 1), (4, 2), (16, 8))  # (inside sensors, heaters) of the benchmarked thermostat
+
+
+def makeDevice(idx, kind):
+    """json description of a device as returned by getdevices, with the usual fields of Domoticz"""
+
+    device = {"AddjMulti": 1.0, "AddjMulti2": 1.0, "AddjValue": 0.0, "AddjValue2": 0.0, "BatteryLevel": 255,
+              "CustomImage": 0, "Data": "", "Description": "", "Favorite": 0, "HardwareDisabled": False,
+              "HardwareID": 3, "HardwareName": "Zigbee", "HardwareType": "Zigbee2MQTT", "HardwareTypeVal": 94,
+              "HaveTimeout": False, "ID": "{:08X}".format(idx), "LastUpdate": "2024-01-01 00:00:00",
+              "Name": "Device {}".format(idx), "Notifications": "false", "PlanID": "0", "PlanIDs": [0],
+              "Protected": False, "ShowNotifications": True, "SignalLevel": "-", "Timers": "false", "Unit": 1,
+              "Used": 1, "XOffset": "0", "YOffset": "0", "idx": str(idx)}
+    if kind == "temp":
+        device.update({"Type": "Temp", "SubType": "LaCrosse TX3", "TypeImg": "temperature", "Temp": 20.0,
+                       "Data": "20.0 C"})
+    elif kind == "light":
+        device.update({"Type": "Light/Switch", "SubType": "Switch", "TypeImg": "lightbulb", "Status": "Off",
+                       "SwitchType": "On/Off", "Data": "Off", "Level": 0, "LevelInt": 0, "MaxDimLevel": 100})
+    else:
+        device.update({"Type": "General", "SubType": "kWh", "TypeImg": "current", "Data": "1234.5 kWh",
+                       "Counter": "1234.5", "CounterToday": "3.2 kWh", "Usage": "120 W"})
+    return device
+
+
+def serve(size, sensors, heaters, targeted, ports):
+    """fake Domoticz json API, run in its own process so that it does not weigh on the measures"""
+
+    # the devices of the thermostat (inside sensors, one outside sensor, heaters) come first
+    ours = {}
+    for idx in range(1, sensors + 2):
+        ours[idx] = makeDevice(idx, "temp")
+    for idx in range(sensors + 2, sensors + heaters + 2):
+        ours[idx] = makeDevice(idx, "light")
+    kinds = ("temp", "light", "light", "temp", "other")
+    others = [makeDevice(idx, kinds[idx % len(kinds)]) for idx in range(len(ours) + 1, max(size, len(ours)) + 1)]
+    # the other devices never change, their json is encoded once
+    encoded = {devicefilter: b",".join(json.dumps(device).encode("utf-8") for device in others
+                                       if devicefilter == "all" or device["TypeImg"] ==
+                                       ("temperature" if devicefilter == "temp" else "lightbulb"))
+               for devicefilter in ("all", "temp", "light")}
+
+    def listing(devicefilter):
+        selected = [device for device in ours.values() if devicefilter == "all" or
+                    ("Temp" in device) == (devicefilter == "temp")]
+        chunks = [json.dumps(device).encode("utf-8") for device in selected]
+        if encoded[devicefilter]:
+            chunks.append(encoded[devicefilter])
+        return b'{"status": "OK", "title": "Devices", "result": [' + b",".join(chunks) + b"]}"
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # else the small responses wait for the delayed acks of the client
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            query = dict(parse.parse_qsl(parse.urlsplit(self.path).query))
+            param = query.get("param")
+            if param == "getdevices" and "rid" in query and targeted:
+                device = ours.get(int(query["rid"]))
+                data = json.dumps({"status": "OK", "result": [device] if device else []}).encode("utf-8")
+            elif param == "getdevices":
+                data = listing(query.get("filter", "all") if "rid" not in query else "all")
+            elif param == "udevice":  # used by the benchmark to set the temperatures
+                device = ours[int(query["idx"])]
+                device["Temp"] = float(query["svalue"])
+                device["LastUpdate"] = query["lastupdate"]
+                data = b'{"status": "OK"}'
+            elif param == "switchlight":
+                device = ours.get(int(query["idx"]))
+                if device is not None:
+                    device["Status"] = query["switchcmd"]
+                data = b'{"status": "OK"}' if device is not None else b'{"status": "ERR"}'
+            elif param == "getuservariables":
+                data = b'{"status": "OK", "result": []}'
+            else:
+                data = b'{"status": "OK"}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def loadPlugin(domoticz, parameters, clock):
+    """(re)loads plugin.py with fresh globals, against the stand-ins of the benchmark and the real API client"""
+
+    sys.modules["Domoticz"] = domoticz
+    if PLUGIN_FOLDER not in sys.path:
+        sys.path.insert(0, PLUGIN_FOLDER)
+    module = importlib.reload(sys.modules["plugin"]) if "plugin" in sys.modules else importlib.import_module("plugin")
+    module.Domoticz = domoticz
+    module.Devices = domoticz.Devices
+    module.Parameters = parameters
+    module.Settings = {"SensorTimeout": "60"}
+    module.clock = clock
+    module.APIWorker = SyncWorker  # the API calls are made (and measured) within the heartbeats
+    return module
+
+
+class Case:
+    """One benchmarked installation: number of devices, of sensors and heaters, targeted queries or scans"""
+
+    def __init__(self, size, sensors, heaters, targeted):
+        self.size = size
+        self.sensors = sensors
+        self.heaters = heaters
+        self.targeted = targeted
+        self.name = "{}-{}s{}h-{}".format(size, sensors, heaters, "rid" if targeted else "scan")
+
+    def run(self, cycles, warmup=2):
+        ports = multiprocessing.Queue()
+        server = multiprocessing.Process(target=serve, args=(self.size, self.sensors, self.heaters, self.targeted,
+                                                             ports), daemon=True)
+        server.start()
+        homefolder = tempfile.mkdtemp(prefix="svt_bench_")
+        try:
+            port = ports.get(timeout=30)
+            return self.measure(port, homefolder, cycles, warmup)
+        finally:
+            server.terminate()
+            server.join()
+            shutil.rmtree(homefolder, ignore_errors=True)
+
+    def measure(self, port, homefolder, cycles, warmup):
+        clock = SimClock(datetime.now().replace(microsecond=0))
+        domoticz = FakeDomoticz()
+        inside = list(range(1, self.sensors + 1))
+        outside = self.sensors + 1
+        heaters = list(range(self.sensors + 2, self.sensors + self.heaters + 2))
+        parameters = {
+            "Address": "127.0.0.1", "Port": str(port), "Username": "", "Password": "",
+            "Mode1": ",".join(str(idx) for idx in inside), "Mode2": str(outside),
+            "Mode3": ",".join(str(idx) for idx in heaters), "Mode4": "Normal", "Mode5": "30,0,2,1,60,0.2",
+            "Mode6": "Normal", "Name": "SVT", "HardwareID": 1, "DomoticzVersion": "2024.7",
+            "HomeFolder": homefolder + os.sep, "StartupFolder": homefolder + os.sep}
+        module = loadPlugin(domoticz, parameters, clock)
+        plugin = module._plugin
+        control = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+
+        def setTemps(temp):
+            for idx in inside + [outside]:
+                control.request("GET", "/json.htm?type=command&param=udevice&idx={}&svalue={}&lastupdate={}".format(
+                    idx, temp if idx != outside else 5.0, parse.quote(clock().strftime("%Y-%m-%d %H:%M:%S"))))
+                control.getresponse().read()
+
+        def cycle(number):
+            # the inside temperature alternates around the setpoint so that the heaters switch at each cycle
+            clock.advance(plugin.calculate_period * 60 + 1)
+            setTemps(18.0 if number % 2 == 0 else 21.0)
+            zone = plugin.zones[0]
+            start = clock()
+            apibytes = self.apiBytes(module)
+            heartbeats = 0
+            elapsed = time.perf_counter()
+            while heartbeats < 10 and (heartbeats == 0 or plugin.worker.pending() or zone.lastcalc < start):
+                plugin.onHeartbeat()
+                heartbeats += 1
+            elapsed = time.perf_counter() - elapsed
+            return elapsed, heartbeats, self.apiBytes(module) - apibytes
+
+        try:
+            setTemps(20.0)
+            plugin.onStart()
+            plugin.onCommand(1, "Set Level", 10, 0)  # thermostat in auto mode
+            plugin.onCommand(4, "Set Level", 20.0, 0)
+            for number in range(warmup):
+                cycle(number)
+            times = []
+            heartbeats = []
+            parsed = []
+            for number in range(cycles):
+                elapsed, count, nbytes = cycle(number)
+                times.append(elapsed)
+                heartbeats.append(count)
+                parsed.append(nbytes)
+            # allocations are measured in separate cycles, tracemalloc slowing down the code
+            peaks = []
+            tracemalloc.start()
+            for number in range(max(2, cycles // 2)):
+                tracemalloc.reset_peak()
+                current = tracemalloc.get_traced_memory()[0]
+                cycle(number)
+                peaks.append(tracemalloc.get_traced_memory()[1] - current)
+            tracemalloc.stop()
+        finally:
+            plugin.onStop()
+            control.close()
+        count = sum(heartbeats)
+        return {"heartbeats_per_cycle": round(count / len(heartbeats), 2),
+                "ms_per_heartbeat": round(1000 * sum(times) / count, 3),
+                "ms_per_cycle_median": round(1000 * statistics.median(times), 3),
+                "ms_per_cycle_max": round(1000 * max(times), 3),
+                "peak_kib_per_cycle": round(statistics.median(peaks) / 1024, 1),
+                "bytes_per_heartbeat": round(sum(parsed) / count),
+                "errors": domoticz.errors}
+
+    @staticmethod
+    def apiBytes(module):
+        return sum(api["bytes"] for api in module._metrics.snapshot()["api"].values())
+
+
+def compare(results, baseline, tolerance):
+    """prints the results against the baseline, returns the list of the regressions"""
+
+    regressions = []
+    header = "{:<22} {:>6} {:>16} {:>18} {:>16} {:>18}".format(
+        "case", "beats", "ms/beat", "ms/cycle", "KiB/cycle", "bytes/beat")
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        reference = baseline.get(name)
+        columns = []
+        for key in ("ms_per_heartbeat", "ms_per_cycle_median", "peak_kib_per_cycle", "bytes_per_heartbeat"):
+            value = result[key]
+            if reference and reference.get(key):
+                ratio = value / reference[key]
+                columns.append("{}({:+.0%})".format(value, ratio - 1))
+                # times are noisy: only flag them beyond the tolerance, and only above a millisecond
+                if ratio > tolerance and (not key.startswith("ms") or value - reference[key] > 1):
+                    regressions.append("{} {}: {} -> {}".format(name, key, reference[key], value))
+            else:
+                columns.append(str(value))
+        print("{:<22} {:>6} {:>16} {:>18} {:>16} {:>18}".format(name, result["heartbeats_per_cycle"], *columns))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart Virtual Thermostat benchmark")
+    parser.add_argument("--sizes", default="10,100,1000,10000", help="numbers of devices in Domoticz")
+    parser.add_argument("--cycles", type=int, default=10, help="measured calculation cycles per case")
+    parser.add_argument("--scan-only", action="store_true", help="only benchmark the full device scans")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--check", action="store_true", help="exit with an error if a result regressed")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="ratio to the baseline flagged as regression")
+    args = parser.parse_args()
+
+    cases = [Case(size, sensors, heaters, targeted)
+             for size in (int(size) for size in args.sizes.split(","))
+             for sensors, heaters in LAYOUTS
+             for targeted in ((False,) if args.scan_only else (True, False))]
+    results = {}
+    for case in cases:
+        results[case.name] = case.run(args.cycles)
+        if results[case.name]["errors"]:
+            print("{}: {} errors logged by the plugin".format(case.name, results[case.name]["errors"]))
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file).get("results", {})
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump({"python": sys.version.split()[0], "date": datetime.now().strftime("%Y-%m-%d"),
+                       "results": results}, file, indent=1)
+        print("Baseline saved to {}".format(args.baseline))
+    if regressions:
+        print("\nRegressions beyond {:.0%} of the baseline:".format(args.tolerance - 1))
+        for regression in regressions:
+            print("  " + regression)
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
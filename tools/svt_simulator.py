@@ -0,0 +1,522 @@
+"""
+Smart Virtual Thermostat simulator
+Runs plugin.py faster than real time against a stand-in of the Domoticz python module and json API,
+and a simple first order thermal model of a room, its heaters and the outside temperature.
+
+Usage: python tools/svt_simulator.py [--scenario winter] [--days 30] [--output trajectory.csv]
+"""
+import sys
+import os
+import math
+import random
+import io
+import json
+import csv
+import shutil
+import tempfile
+import argparse
+import importlib
+from datetime import datetime, timedelta
+from urllib import parse
+
+PLUGIN_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# scenarios are repeatable: all the randomness comes from the seeded generator of the simulation
+SCENARIOS = {
+    "winter": {
+        "description": "cold month, eco setpoint at night",
+        "days": 30, "start": "2023-01-02 00:00:00",
+        "outside": {"mean": 3., "amplitude": 4., "drift": 0., "noise": 0.3},
+        "room": {"temp": 17., "capacity": 4000., "loss": 0.08, "power": 2.0},
+        "setpoints": {"normal": 20., "economy": 17.}, "economy": (23, 6),
+        "events": []},
+    "mild": {
+        "description": "spring month, outside temperature rising",
+        "days": 30, "start": "2023-04-01 00:00:00",
+        "outside": {"mean": 10., "amplitude": 6., "drift": 0.2, "noise": 0.3},
+        "room": {"temp": 18., "capacity": 4000., "loss": 0.08, "power": 2.0},
+        "setpoints": {"normal": 20., "economy": 17.}, "economy": (23, 6),
+        "events": []},
+    "cold_snap": {
+        "description": "outside temperature dropping by 12 degrees after one week",
+        "days": 21, "start": "2023-01-02 00:00:00",
+        "outside": {"mean": 5., "amplitude": 3., "drift": 0., "noise": 0.3},
+        "room": {"temp": 18., "capacity": 4000., "loss": 0.08, "power": 2.0},
+        "setpoints": {"normal": 20., "economy": 20.}, "economy": None,
+        "events": [(7, "outside_mean", -7.)]},
+    "heater_change": {
+        "description": "heater replaced by a more powerful one after two weeks (relearning)",
+        "days": 42, "start": "2023-01-02 00:00:00",
+        "outside": {"mean": 3., "amplitude": 4., "drift": 0., "noise": 0.3},
+        "room": {"temp": 18., "capacity": 4000., "loss": 0.08, "power": 1.5},
+        "setpoints": {"normal": 20., "economy": 20.}, "economy": None,
+        "events": [(14, "heater_power", 3.0)]},
+    "shared_snapshot": {
+        "description": "cold week, the devices read from the device snapshot shared between SVT hardware",
+        "days": 7, "start": "2023-01-02 00:00:00",
+        "outside": {"mean": 3., "amplitude": 4., "drift": 0., "noise": 0.3},
+        "room": {"temp": 17., "capacity": 4000., "loss": 0.08, "power": 2.0},
+        "setpoints": {"normal": 20., "economy": 17.}, "economy": (23, 6),
+        "events": [], "config": {"SharedSnapshot": True}},
+    "api_outage": {
+        "description": "cold week, the Domoticz web server not answering for 3 hours on the second day",
+        "days": 7, "start": "2023-01-02 00:00:00",
+        "outside": {"mean": 3., "amplitude": 4., "drift": 0., "noise": 0.3},
+        "room": {"temp": 17., "capacity": 4000., "loss": 0.08, "power": 2.0},
+        "setpoints": {"normal": 20., "economy": 17.}, "economy": (23, 6),
+        "events": [(1, "api_outage", 3.)]},
+}
+
+
+class SimClock:
+    """Simulated clock, used as the plugin's clock"""
+
+    def __init__(self, start):
+        self.time = start
+
+    def __call__(self):
+        return self.time
+
+    def advance(self, seconds):
+        self.time += timedelta(seconds=seconds)
+
+
+class FakeDevice:
+    """Stand-in for a Domoticz.Device"""
+
+    def __init__(self, domoticz, Name="", Unit=0, TypeName="", Type=0, Subtype=0, Switchtype=0, Image=0,
+                 Options=None, Used=0, **kwargs):
+        self.domoticz = domoticz
+        self.Name = Name
+        self.Unit = Unit
+        self.ID = Unit
+        self.TypeName = TypeName
+        self.Options = Options or {}
+        self.Used = Used
+        self.nValue = 0
+        self.sValue = ""
+        self.LastLevel = 0
+        self.TimedOut = False
+
+    def Create(self):
+        self.domoticz.Devices[self.Unit] = self
+
+    def Update(self, nValue=0, sValue="", TimedOut=None, **kwargs):
+        self.nValue = nValue
+        self.sValue = sValue
+        if TimedOut is not None:
+            self.TimedOut = TimedOut
+
+
+class FakeConnection:
+    """Stand-in for a Domoticz.Connection to an MQTT broker: the broker answers immediately, and the events
+    are delivered to the plugin by the simulation before the next heartbeat"""
+
+    def __init__(self, domoticz, Name="", Transport="", Protocol="", Address="", Port=""):
+        self.domoticz = domoticz
+        self.Name = Name
+        self.Protocol = Protocol
+        self.connected = False
+        self.connecting = False
+        self.topics = []
+
+    def Connect(self):
+        self.connecting = True
+        self.domoticz.events.append(("onConnect", self, 0, ""))
+
+    def Connected(self):
+        return self.connected
+
+    def Connecting(self):
+        return self.connecting
+
+    def Disconnect(self):
+        self.connected = self.connecting = False
+        self.topics = []
+        self.domoticz.events.append(("onDisconnect", self))
+
+    def Send(self, message):
+        verb = message["Verb"]
+        if verb == "CONNECT":
+            self.domoticz.events.append(("onMessage", self, {"Verb": "CONNACK"}))
+        elif verb == "SUBSCRIBE":
+            self.topics = [topic["Topic"] for topic in message["Topics"]]
+            self.domoticz.events.append(("onMessage", self, {"Verb": "SUBACK"}))
+        elif verb == "PING":
+            self.domoticz.events.append(("onMessage", self, {"Verb": "PINGRESP"}))
+
+    def publish(self, topic, payload):
+        if topic in self.topics:
+            self.domoticz.events.append(("onMessage", self, {"Verb": "PUBLISH", "Topic": topic, "QoS": 0,
+                                                             "Payload": json.dumps(payload).encode("utf-8")}))
+
+
+class FakeDomoticz:
+    """Stand-in for the Domoticz python module, installed as sys.modules["Domoticz"]"""
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.Devices = {}
+        self.messages = []
+        self.errors = 0
+        self.heartbeat = 10
+        self.connections = []
+        self.events = []  # connection events waiting to be delivered to the plugin
+
+    def record(self, level, message):
+        if level == "Error":
+            self.errors += 1
+        if self.verbose or level == "Error":
+            self.messages.append((level, message))
+            if self.verbose:
+                print("{}: {}".format(level, message))
+
+    def Debug(self, message):
+        if self.verbose:
+            self.record("Debug", message)
+
+    def Log(self, message):
+        self.record("Log", message)
+
+    def Status(self, message):
+        self.record("Status", message)
+
+    def Error(self, message):
+        self.record("Error", message)
+
+    def Debugging(self, level):
+        pass
+
+    def Heartbeat(self, seconds):
+        self.heartbeat = seconds
+
+    def Device(self, **kwargs):
+        return FakeDevice(self, **kwargs)
+
+    def Connection(self, **kwargs):
+        connection = FakeConnection(self, **kwargs)
+        self.connections.append(connection)
+        return connection
+
+    def publish(self, device):
+        """pushes a temperature update on the MQTT output, as Domoticz does"""
+        payload = {"idx": int(device["idx"]), "name": device["Name"], "dtype": "Temp", "nvalue": 0,
+                   "svalue1": str(device["Temp"])}
+        for connection in self.connections:
+            connection.publish("domoticz/out", payload)
+
+    def deliverEvents(self, module):
+        events, self.events = self.events, []
+        for event in events:
+            if event[0] == "onConnect":
+                event[1].connected, event[1].connecting = True, False
+            getattr(module, event[0])(*event[1:])
+
+
+class FakeDomoticzAPI:
+    """Stand-in for the Domoticz json API, serving the devices of the simulation to plugin._api.fetch"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.devices = {}
+        self.uservariables = {}
+        self.calls = {}
+        self.bytes = 0
+        self.downuntil = None  # the web server does not answer until then
+
+    def addTemp(self, idx, name, temp):
+        self.devices[idx] = {"idx": str(idx), "Name": name, "Type": "Temp", "Temp": temp, "Used": 1,
+                             "LastUpdate": self.clock().strftime("%Y-%m-%d %H:%M:%S")}
+
+    def addSwitch(self, idx, name):
+        self.devices[idx] = {"idx": str(idx), "Name": name, "Type": "Light/Switch", "Status": "Off", "Used": 1,
+                             "LastUpdate": self.clock().strftime("%Y-%m-%d %H:%M:%S")}
+
+    def setTemp(self, idx, temp):
+        """updates a temperature sensor, returns True if its value changed"""
+        device = self.devices[idx]
+        changed = device["Temp"] != temp
+        device["Temp"] = temp
+        device["LastUpdate"] = self.clock().strftime("%Y-%m-%d %H:%M:%S")
+        return changed
+
+    def isOn(self, idx):
+        return self.devices[idx]["Status"] == "On"
+
+    def handle(self, query):
+        param = query.get("param", query.get("type"))
+        self.calls[param] = self.calls.get(param, 0) + 1
+        result = {"status": "OK"}
+        if param == "getdevices":
+            if "rid" in query:
+                idx = int(query["rid"])
+                if idx in self.devices:
+                    result["result"] = [self.devices[idx]]
+            else:
+                devicefilter = query.get("filter", "all")
+                result["result"] = [device for device in self.devices.values() if devicefilter == "all" or
+                                    (devicefilter == "temp") == ("Temp" in device)]
+        elif param == "switchlight":
+            device = self.devices.get(int(query["idx"]))
+            if device is None or "Status" not in device:
+                result["status"] = "ERR"
+            else:
+                device["Status"] = query["switchcmd"]
+                device["LastUpdate"] = self.clock().strftime("%Y-%m-%d %H:%M:%S")
+        elif param == "getuservariables":
+            result["result"] = [{"Name": name, "Value": value} for name, value in self.uservariables.items()]
+        elif param in ("adduservariable", "updateuservariable"):
+            self.uservariables[query["vname"]] = query["vvalue"]
+        else:
+            result["status"] = "ERR"
+        return result
+
+    def fetch(self, path, stream=None):
+        if self.downuntil is not None and self.clock() < self.downuntil:
+            raise ConnectionRefusedError(111, "Connection refused")
+        query = dict(parse.parse_qsl(parse.urlsplit(path).query))
+        data = json.dumps(self.handle(query)).encode("utf-8")
+        self.bytes += len(data)
+        return 200, stream.read(io.BytesIO(data)) if stream is not None else data
+
+
+class SyncWorker:
+    """Stand-in for plugin.APIWorker running the jobs synchronously, so that simulations are repeatable"""
+
+    def __init__(self):
+        self.results = []
+
+    def start(self):
+        pass
+
+    def submit(self, job, callback=None):
+        result = job()
+        if callback is not None:
+            self.results.append((callback, result))
+
+    def pending(self):
+        return bool(self.results)
+
+    def processResults(self):
+        count = 0
+        while self.results:
+            callback, result = self.results.pop(0)
+            callback(result)
+            count += 1
+        return count
+
+    def stop(self, timeout=None):
+        pass
+
+
+class Weather:
+    """Outside temperature: daily sine wave (coldest at 5am) + linear drift per day + noise"""
+
+    def __init__(self, rng, mean, amplitude, drift, noise):
+        self.rng = rng
+        self.mean = mean
+        self.amplitude = amplitude
+        self.drift = drift
+        self.noise = noise
+
+    def temp(self, days):
+        return (self.mean + self.drift * days - self.amplitude * math.cos(2 * math.pi * (days % 1 - 5 / 24)) +
+                self.rng.gauss(0, self.noise))
+
+
+class Room:
+    """First order thermal model of a room: capacity in kJ/K, loss in kW/K, heater power in kW"""
+
+    def __init__(self, temp, capacity, loss, power):
+        self.temp = temp
+        self.capacity = capacity
+        self.loss = loss
+        self.power = power
+
+    def step(self, seconds, heating, outside):
+        # exact solution of C.dT/dt = P - UA.(T - Tout) over the time step
+        equilibrium = outside + (self.power if heating else 0.) / self.loss
+        self.temp = equilibrium + (self.temp - equilibrium) * math.exp(-seconds * self.loss / self.capacity)
+        return self.temp
+
+
+class Simulation:
+    """One run of the plugin over a scenario"""
+
+    def __init__(self, scenario="winter", seed=0, heartbeat=None, parameters=None, config=None, verbose=False):
+        self.scenario = dict(SCENARIOS[scenario]) if isinstance(scenario, str) else dict(scenario)
+        self.rng = random.Random(seed)
+        self.fixedheartbeat = heartbeat
+        self.clock = SimClock(datetime.strptime(self.scenario["start"], "%Y-%m-%d %H:%M:%S"))
+        self.domoticz = FakeDomoticz(verbose)
+        self.api = FakeDomoticzAPI(self.clock)
+        self.weather = Weather(self.rng, **self.scenario["outside"])
+        self.room = Room(**self.scenario["room"])
+        self.homefolder = tempfile.mkdtemp(prefix="svt_sim_")
+        self.trajectory = []
+        self.switches = 0
+        self.energy = 0.  # kWh
+        self.errorsum = 0.
+        self.errortime = 0.
+
+        # one inside sensor, one outside sensor and one heater
+        self.api.addTemp(1, "Room", self.room.temp)
+        self.api.addTemp(2, "Outside", round(self.weather.temp(0), 1))
+        self.api.addSwitch(3, "Heater")
+        self.parameters = {
+            "Address": "127.0.0.1", "Port": "8080", "Username": "", "Password": "",
+            "Mode1": "1", "Mode2": "2", "Mode3": "3", "Mode4": "Normal", "Mode5": "30,0,2,1,60,0.2",
+            "Mode6": "Verbose" if verbose else "Normal",
+            "Name": "SVT", "HardwareID": 1, "DomoticzVersion": "2024.7", "HomeFolder": self.homefolder + os.sep,
+            "StartupFolder": self.homefolder + os.sep}
+        self.parameters.update(parameters or {})
+        config = dict(self.scenario.get("config", {}), **(config or {}))
+        if config:
+            with open(os.path.join(self.homefolder, "svt_config.json"), "w") as file:
+                json.dump({"default": config}, file)
+        self.plugin = loadPlugin(self)
+        self.module = sys.modules["plugin"]
+
+    def setpointMode(self, days):
+        """returns the level of the thermostat mode selector scheduled at that time (10 = normal, 20 = eco)"""
+        if not self.scenario["economy"]:
+            return "10"
+        start, end = self.scenario["economy"]
+        hour = (days % 1) * 24
+        economy = hour >= start or hour < end if start > end else start <= hour < end
+        return "20" if economy else "10"
+
+    def applyEvents(self, day):
+        for eventday, event, value in self.scenario["events"]:
+            if eventday == day:
+                if event == "outside_mean":
+                    self.weather.mean = value
+                elif event == "heater_power":
+                    self.room.power = value
+                elif event == "api_outage":  # in hours
+                    self.api.downuntil = self.clock() + timedelta(hours=value)
+
+    def run(self, days=None, record=300):
+        """runs the simulation, recording the trajectory every 'record' seconds, and returns a summary"""
+
+        days = days or self.scenario["days"]
+        plugin = self.plugin
+        Devices = self.domoticz.Devices
+        start = self.clock()
+        end = start + timedelta(days=days)
+        try:
+            plugin.onStart()
+            for unit, svalue in ((1, "10"), (2, "10"), (4, str(self.scenario["setpoints"]["normal"])),
+                                 (5, str(self.scenario["setpoints"]["economy"]))):
+                plugin.onCommand(unit, "Set Level", float(svalue) if unit > 3 else int(svalue), 0)
+            nextrecord = start
+            lastday = -1
+            heating = self.api.isOn(3)
+            while self.clock() < end:
+                elapsed = (self.clock() - start).total_seconds() / 86400
+                if int(elapsed) != lastday:
+                    lastday = int(elapsed)
+                    self.applyEvents(lastday)
+                mode = self.setpointMode(elapsed)
+                if Devices[2].sValue != mode:
+                    plugin.onCommand(2, "Set Level", int(mode), 0)
+
+                # heartbeat, then advance the thermal model until the next one
+                self.domoticz.deliverEvents(self.module)
+                plugin.onHeartbeat()
+                if self.api.isOn(3) != heating:
+                    heating = not heating
+                    self.switches += 1
+                step = self.fixedheartbeat or self.domoticz.heartbeat
+                outside = self.weather.temp(elapsed)
+                self.room.step(step, heating, outside)
+                self.clock.advance(step)
+                for idx, temp in ((1, self.room.temp + self.rng.gauss(0, 0.05)), (2, outside)):
+                    if self.api.setTemp(idx, round(temp, 1)):
+                        self.domoticz.publish(self.api.devices[idx])
+                if heating:
+                    self.energy += self.room.power * step / 3600
+                setpoint = float(Devices[4 if mode == "10" else 5].sValue)
+                if Devices[1].sValue != "0":
+                    self.errorsum += abs(setpoint - self.room.temp) * step
+                    self.errortime += step
+
+                if record and self.clock() >= nextrecord:
+                    nextrecord += timedelta(seconds=record)
+                    zone = plugin.zones[0]
+                    self.trajectory.append((self.clock().strftime("%Y-%m-%d %H:%M:%S"), round(self.room.temp, 2),
+                                            round(outside, 2), setpoint, int(heating), zone.Internals["LastPwr"],
+                                            zone.Internals["ConstC"], zone.Internals["ConstT"]))
+        finally:
+            plugin.onStop()
+        return self.summary(days)
+
+    def summary(self, days):
+        zone = self.plugin.zones[0]
+        return {"days": days,
+                "comfort_error": round(self.errorsum / self.errortime, 3) if self.errortime else None,
+                "switches": self.switches,
+                "energy_kwh": round(self.energy, 1),
+                "ConstC": zone.Internals["ConstC"],
+                "ConstT": zone.Internals["ConstT"],
+                "api_calls": sum(self.api.calls.values()),
+                "api_bytes": self.api.bytes,
+                "errors": self.domoticz.errors}
+
+    def saveTrajectory(self, filename):
+        with open(filename, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(("time", "intemp", "outtemp", "setpoint", "heat", "power", "ConstC", "ConstT"))
+            writer.writerows(self.trajectory)
+
+    def cleanup(self):
+        shutil.rmtree(self.homefolder, ignore_errors=True)
+
+
+def loadPlugin(simulation):
+    """(re)initializes plugin.py to run against the stand-ins of the simulation, and returns its BasePlugin"""
+
+    sys.modules["Domoticz"] = simulation.domoticz
+    if PLUGIN_FOLDER not in sys.path:
+        sys.path.insert(0, PLUGIN_FOLDER)
+    module = importlib.import_module("plugin")
+    module.Domoticz = simulation.domoticz
+    module.Devices = simulation.domoticz.Devices
+    module.Parameters = simulation.parameters
+    module.Settings = {"SensorTimeout": "60"}
+    module.clock = simulation.clock
+    module.APIWorker = SyncWorker
+    module._api = module.APIConnection()
+    module._api.fetch = simulation.api.fetch
+    module._plugin = module.BasePlugin()
+    return module._plugin
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart Virtual Thermostat simulator")
+    parser.add_argument("--scenario", default="winter", choices=sorted(SCENARIOS))
+    parser.add_argument("--days", type=float, default=None, help="duration (default: the scenario's)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--heartbeat", type=int, default=None,
+                        help="fixed heartbeat in seconds (default: as requested by the plugin)")
+    parser.add_argument("--mode5", default=None, help="plugin Mode5 parameter (e.g. '30,0,2,1,60,0.2')")
+    parser.add_argument("--config", default=None, help="advanced settings as json (e.g. '{\"Calibration\": \"batch\"}')")
+    parser.add_argument("--output", default=None, help="csv file for the recorded trajectory")
+    parser.add_argument("--verbose", action="store_true", help="print the plugin's log")
+    args = parser.parse_args()
+
+    parameters = {"Mode5": args.mode5} if args.mode5 else None
+    config = json.loads(args.config) if args.config else None
+    simulation = Simulation(args.scenario, seed=args.seed, heartbeat=args.heartbeat, parameters=parameters,
+                            config=config, verbose=args.verbose)
+    try:
+        summary = simulation.run(days=args.days)
+        if args.output:
+            simulation.saveTrajectory(args.output)
+    finally:
+        simulation.cleanup()
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Smart Virtual Thermostat parameter sweep
+Replays the recorded cycles of a zone (the svt_cycles_<hardware id>.bin archive of the plugin) over a grid of
+settings: calculation period, minimum heating, delta max, boost and boost gap. A first order thermal model of the
+room is fitted on the recorded cycles, and each combination runs the plugin itself (its AutoMode and AutoCallib
+code) in the simulator, against that room and the recorded outside temperatures and setpoints. The runs are
+spread over a pool of processes, and the settings are ranked by comfort error, heater switches and energy.
+
+Usage: python tools/svt_sweep.py --archive svt_cycles_3.bin [--zone 1] [--periods 20,30,45] [--workers 4]
+       python tools/svt_sweep.py --scenario winter  (replays a recording of the simulator, to try the tool)
+"""
+import sys
+import os
+import csv
+import time
+import bisect
+import argparse
+import itertools
+import concurrent.futures
+from datetime import datetime
+
+from svt_simulator import PLUGIN_FOLDER, SCENARIOS, FakeDomoticz, Simulation
+
+CAPACITY = 4000.  # kJ/K, arbitrary: only the ratios of the power and loss to the capacity are fitted
+
+
+def loadArchive(filename, zone):
+    """returns the detailed cycles of the zone recorded in the archive file"""
+
+    sys.modules.setdefault("Domoticz", FakeDomoticz())
+    if PLUGIN_FOLDER not in sys.path:
+        sys.path.insert(0, PLUGIN_FOLDER)
+    import plugin
+    # read only: the constructor of CycleArchive would repair the file of a running plugin
+    archive = plugin.CycleArchive.__new__(plugin.CycleArchive)
+    return [cycle for cycle in archive.readFile(filename, 0, 2 ** 32 - 1) if cycle.zone == zone and not cycle.daily]
+
+
+def recordScenario(scenario, days):
+    """runs the simulator over a scenario and returns the cycles archived by the plugin"""
+
+    simulation = Simulation(scenario)
+    try:
+        simulation.run(days=days, record=0)
+        return loadArchive(os.path.join(simulation.homefolder, "svt_cycles_1.bin"), 1)
+    finally:
+        simulation.cleanup()
+
+
+def fitRoom(cycles):
+    """least squares fit of the room model over consecutive cycles:
+    temperature rise = power / capacity * heat seconds - loss / capacity * (inside - outside temp) * seconds"""
+
+    sxx = sxy = syy = sx = sy = 0.
+    count = 0
+    for cycle, following in zip(cycles, cycles[1:]):
+        seconds = following.time - cycle.time
+        if cycle.outtemp is None or not 0 < seconds <= 2 * cycle.period * 60:
+            continue  # no outside temperature, or a gap in the recording
+        x = min(cycle.heat, seconds)
+        y = -(cycle.intemp - cycle.outtemp) * seconds
+        rise = following.intemp - cycle.intemp
+        sxx += x * x
+        sxy += x * y
+        syy += y * y
+        sx += x * rise
+        sy += y * rise
+        count += 1
+    determinant = sxx * syy - sxy * sxy
+    if count < 20 or determinant == 0:
+        raise ValueError("not enough consecutive cycles with an outside temperature to fit a model of the room")
+    power = (sx * syy - sy * sxy) / determinant
+    loss = (sy * sxx - sx * sxy) / determinant
+    if power <= 0 or loss <= 0:
+        raise ValueError("the recorded cycles do not fit a model of the room (power {:.2g}, loss {:.2g})".format(
+            power, loss))
+    return {"temp": cycles[0].intemp, "capacity": CAPACITY, "loss": loss * CAPACITY, "power": power * CAPACITY}
+
+
+class Series:
+    """Recorded values as a function of the days since the start of the recording"""
+
+    def __init__(self, start, points, step=False):
+        self.days = [(when - start) / 86400 for when, value in points]
+        self.values = [value for when, value in points]
+        self.step = step  # the value holds until the next point, else it is interpolated
+
+    def value(self, days):
+        index = bisect.bisect_right(self.days, days)
+        if index == 0:
+            return self.values[0]
+        if index == len(self.days) or self.step:
+            return self.values[index - 1]
+        ratio = (days - self.days[index - 1]) / (self.days[index] - self.days[index - 1])
+        return self.values[index - 1] + ratio * (self.values[index] - self.values[index - 1])
+
+    def temp(self, days):  # as a svt_simulator.Weather
+        return self.value(days)
+
+
+class Replay(Simulation):
+    """Simulation against the fitted room, with the recorded outside temperatures and setpoints"""
+
+    def __init__(self, recording, parameters, config):
+        start = recording["start"]
+        setpoints = recording["setpoints"]
+        scenario = {"days": recording["days"], "start": datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M:%S"),
+                    "outside": {"mean": 0., "amplitude": 0., "drift": 0., "noise": 0.}, "room": recording["room"],
+                    "setpoints": {"normal": setpoints[0][1], "economy": setpoints[0][1]}, "economy": None,
+                    "events": []}
+        super().__init__(scenario, parameters=parameters, config=config)
+        self.weather = Series(start, recording["outside"])
+        self.setpoints = Series(start, setpoints, step=True)
+
+    def setpointMode(self, days):
+        setpoint = self.setpoints.value(days)
+        if float(self.domoticz.Devices[4].sValue) != setpoint:
+            self.plugin.onCommand(4, "Set Level", setpoint, 0)
+        return "10"
+
+
+def replay(recording, settings):
+    """runs one combination of settings, returns the settings with the summary of the run"""
+
+    period, minheat, deltamax, boost, boostgap = settings
+    simulation = Replay(recording, {"Mode5": "{},{},2,1,60,{}".format(period, minheat, deltamax)},
+                        {"Boost": boost, "BoostGap": boostgap, "CycleArchive": False})
+    try:
+        summary = simulation.run(record=0)
+    finally:
+        simulation.cleanup()
+    return {"period": period, "minheat": minheat, "deltamax": deltamax, "boost": boost, "boostgap": boostgap,
+            "comfort_error": summary["comfort_error"], "switches": summary["switches"],
+            "energy_kwh": summary["energy_kwh"], "errors": summary["errors"]}
+
+
+def rank(results):
+    """sorts the results by the sum of their ranks in comfort error, heater switches and energy"""
+
+    for key in ("comfort_error", "switches", "energy_kwh"):
+        ordered = sorted(results, key=lambda result: result[key])
+        for result in results:
+            result.setdefault("rank", 0)
+            result["rank"] += bisect.bisect_left([other[key] for other in ordered], result[key]) + 1
+    return sorted(results, key=lambda result: (result["rank"], result["comfort_error"]))
+
+
+def parseList(text, cast):
+    return [cast(value) for value in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart Virtual Thermostat parameter sweep")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--archive", help="cycle archive of the plugin (svt_cycles_<hardware id>.bin)")
+    source.add_argument("--scenario", choices=sorted(SCENARIOS), help="replay a recording of the simulator")
+    parser.add_argument("--zone", type=int, default=1, help="zone of the archive to replay")
+    parser.add_argument("--days", type=float, default=None, help="replay only the last days of the recording")
+    parser.add_argument("--periods", default="20,30,45", help="calculation periods in minutes")
+    parser.add_argument("--minheat", default="0,10", help="minimum heating in %")
+    parser.add_argument("--deltamax", default="0.1,0.2,0.4", help="allowed temperature excess in °C")
+    parser.add_argument("--boost", default="on,off", help="boost mode")
+    parser.add_argument("--boostgap", default="0.5,1.0", help="boost gap in °C")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: one per CPU)")
+    parser.add_argument("--top", type=int, default=10, help="number of settings shown")
+    parser.add_argument("--output", default=None, help="csv file for all the results")
+    args = parser.parse_args()
+
+    if args.archive:
+        cycles = loadArchive(args.archive, args.zone)
+    else:
+        cycles = recordScenario(args.scenario, args.days)
+    if args.days and cycles:
+        cycles = [cycle for cycle in cycles if cycle.time >= cycles[-1].time - args.days * 86400]
+    if len(cycles) < 2:
+        sys.exit("No recorded cycles to replay")
+    try:
+        room = fitRoom(cycles)
+    except ValueError as error:
+        sys.exit(str(error))
+    recording = {"start": cycles[0].time, "days": (cycles[-1].time - cycles[0].time) / 86400, "room": room,
+                 "outside": [(cycle.time, cycle.outtemp) for cycle in cycles if cycle.outtemp is not None],
+                 "setpoints": [(cycle.time, cycle.setpoint) for cycle in cycles]}
+    if not recording["outside"]:
+        sys.exit("No outside temperature in the recorded cycles")
+    print("{} cycles over {:.1f} days, fitted room: heater {:.2f} kW, loss {:.3f} kW/K".format(
+        len(cycles), recording["days"], room["power"], room["loss"]))
+
+    grid = list(itertools.product(parseList(args.periods, int), parseList(args.minheat, int),
+                                  parseList(args.deltamax, float),
+                                  [boost.strip().lower() in ("on", "true", "1") for boost in args.boost.split(",")],
+                                  parseList(args.boostgap, float)))
+    # the boost gap is irrelevant without boost
+    grid = sorted(set((period, minheat, deltamax, boost, boostgap if boost else 0.)
+                      for period, minheat, deltamax, boost, boostgap in grid))
+    print("Replaying {} combinations of settings...".format(len(grid)))
+    start = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(replay, itertools.repeat(recording), grid))
+    results = rank(results)
+    print("Done in {:.0f} seconds\n".format(time.monotonic() - start))
+
+    header = "{:>6} {:>8} {:>9} {:>6} {:>9} {:>14} {:>9} {:>11}".format(
+        "period", "minheat", "deltamax", "boost", "boostgap", "comfort error", "switches", "energy kWh")
+    print(header)
+    print("-" * len(header))
+    for result in results[:args.top]:
+        print("{period:>6} {minheat:>8} {deltamax:>9} {boost:>6} {boostgap:>9} {comfort_error:>14} {switches:>9} "
+              "{energy_kwh:>11}".format(**dict(result, boost="on" if result["boost"] else "off")))
+    if args.output:
+        with open(args.output, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,20 @@
 
-var hardwareReq = "/json.htm?type=hardware";
-var tempReq = "/json.htm?type=graph&sensor=temp&range=day&idx=";
-var switchReq = "/json.htm?type=lightlog&idx=";
-var devicesReq = "/json.htm?type=devices";
+var historyReq = "/templates/svt_history.json"; // published by the plugin when its History setting is on
 
 class Thermostat {
-	constructor() {
-		this.name = "";
-		this.tempIn = undefined;
-		this.tempOut = undefined;
-		this.heater=undefined;
+	constructor(name, columns, samples) {
+		this.name = name;
+		this.columns = columns;
+		this.samples = samples;
 	}
-}
-class Heater {
-	constructor() {
-		this.historic=undefined;
-		this.isDimmer=false;
+	// values of one column of the history, as [time in ms, value] with local time shown as UTC by Highcharts
+	series(column) {
+		var t = this.columns.indexOf("time");
+		var c = this.columns.indexOf(column);
+		return this.samples.filter(item => item[c] != null).map(function (item) {
+			var time = item[t] * 1000;
+			return [time - new Date(time).getTimezoneOffset() * 60000, item[c]];
+		});
 	}
 }
 Date.prototype.yyyymmdd_hhmm = function() {
@@ -40,107 +39,24 @@ function getRequestParam(name){
 	if(name=(new RegExp('[?&]'+encodeURIComponent(name)+'=([^&]*)')).exec(req))
 		return decodeURIComponent(name[1]);
 }
-function getThermostats() {
-	var request=proto+address + ":" + port.toString() + hardwareReq;
-	var thermostats = [];
+// the plugin publishes the downsampled history of all its thermostats in one file, loaded in a single request
+function getThermostats(callback) {
+	var request=proto+address + ":" + port.toString() + historyReq;
 	$.ajax({url: request,
-		async: false,
+		dataType: "json",
+		cache: false,
 		success: function(result){
-			for(i=0;i<result.result.length;i++) {
-				if(result.result[i].Extra == "SVT") {
-					var thermostat = new Thermostat();
-					var heats=[];
-					var tempOut = undefined;
-					var tempInIdxs = result.result[i].Mode1.split(',');
-					var tempOutIdx = result.result[i].Mode2;
-					var tempOutIdxs = result.result[i].Mode2.split(',');
-					var heatIdxs = result.result[i].Mode3.split(',');
-					var name = result.result[i].Name;
-					thermostat.name = name;
-					thermostat.id = result.result[i].idx;
-					var minDate = 0;
-					var request=proto+address + ":" + port.toString() + tempReq + tempInIdxs[0];
-					$.ajax({url: request,
-						async: false,
-						success: function(resultTemp){
-							//console.log(resultTemp);
-							thermostat.tempIn = resultTemp.result;
-							minDate = Math.min.apply(null,
-								resultTemp.result.map(function (item) {
-									return new Date(item.d);
-								})
-							);
-						}
-					});
-					if(tempOutIdx != undefined && tempOutIdxs[0] >= 0) {
-						request=proto+address + ":" + port.toString() + tempReq + tempOutIdxs[0];
-						$.ajax({url: request,
-							async: false,
-							success: function(resultTemp){
-								//console.log(resultTemp);
-								thermostat.tempOut = resultTemp.result;
-								var minDate2 = Math.min.apply(null, 
-									resultTemp.result.map(function (item) {
-										return new Date(item.d);
-									})
-								);
-								minDate = Math.min(minDate, minDate2);
-							}
-						});
-					}
-					request=proto+address + ":" + port.toString() + switchReq + heatIdxs[0];
-					$.ajax({url: request,
-						async: false,
-						success: function(resultTemp){
-							//console.log(resultTemp);
-							thermostat.heater = new Heater();
-							//thermostat.heater.isDimmer = resultTemp.HaveDimmer; // not working, HaveDimmer always true
-							try {
-								thermostat.heater.historic = resultTemp.result.filter(item => new Date(item.Date).getTime() >= minDate).sort((a,b)=>new Date(a.Date).getTime()>new Date(b.Date).getTime());
-							}
-							catch( err ) {
-								thermostat.heater.historic = undefined
-							}
-						}
-					});
-					request=proto+address + ":" + port.toString() + devicesReq;
-					$.ajax({url: request,
-						async: false,
-						success: function(resultTemp){
-							for(var j=0;j<resultTemp.result.length;j++) {
-								if(thermostat.id == resultTemp.result[j].HardwareID && resultTemp.result[j].Unit == 4) {
-									request=proto+address + ":" + port.toString() + tempReq + resultTemp.result[j].idx;
-									$.ajax({url: request,
-										async: false,
-										success: function(resultTemp2){
-											//console.log(resultTemp2);
-											thermostat.setpoint = resultTemp2.result;
-										}
-									});
-								}
-								if(thermostat.id == resultTemp.result[j].HardwareID && resultTemp.result[j].Unit == 6) {
-									tempInIdxs[0] = resultTemp.result[j].idx;
-								}
-								if(heatIdxs[0] == resultTemp.result[j].idx) {
-									thermostat.heater.isDimmer = resultTemp.result[j].SwitchType == "Dimmer";
-								}
-							}
-						}
-					});
-					request=proto+address + ":" + port.toString() + tempReq + tempInIdxs[0];
-					$.ajax({url: request,
-						async: false,
-						success: function(resultTemp){
-								if( resultTemp.result != undefined ) {
-									thermostat.tempIn = resultTemp.result;
-								}
-							}
-					});
-					thermostats.push(thermostat);
+			var thermostats = [];
+			for(var hardware in result.thermostats) {
+				var entry = result.thermostats[hardware];
+				for(var zone in entry.zones) {
+					thermostats.push(new Thermostat(entry.zones[zone].name, entry.columns, entry.zones[zone].samples));
 				}
 			}
-			//console.log(thermostats);
+			callback(thermostats);
+		},
+		error: function(request, status, error){
+			callback([], "history of the thermostats not available ( " + status + " " + error + " )");
 		}
 	});
-	return thermostats;
 }